@@ -0,0 +1,118 @@
+"""
+image_optimizer_benchmark.py
+Decode benchmark for the image optimizer engine (image_optimizer_engine.py):
+- Compares the full-resolution decode + resize path with JPEG draft (DCT-scaled) decoding
+- Reports median decode/resize time and peak memory of a fresh worker process per mode
+- Uses a synthetic 24 MP camera-like JPEG unless real files are given
+Usage:
+    python image_optimizer_benchmark.py
+    python image_optimizer_benchmark.py photos/*.jpg --repeat 5 --out decode_bench.json
+"""
+
+import sys
+import json
+import time
+import argparse
+import statistics
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+import image_optimizer_engine as engine
+
+try:
+    import resource  # not available on Windows
+except ImportError:
+    resource = None
+
+# ---------- Config ----------
+SYNTHETIC_SIZE = (6000, 4000)     # 24 MP, typical APS-C camera
+REPEAT = 3
+MAX_DIMENSION = engine.OptimizerConfig().max_dimension
+
+# ---------- Synthetic input ----------
+def synthetic_jpeg(path: Path, size=SYNTHETIC_SIZE):
+    """Gradient plus noise so the JPEG has camera-like entropy (and file size)."""
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 40)
+    img = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    img.save(path, format="JPEG", quality=92)
+
+# ---------- Benchmark ----------
+def peak_rss_mb() -> float:
+    if resource is None:
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024  # bytes on macOS, KB on Linux
+
+def decode_and_resize(path: Path, draft: bool):
+    img = engine.open_image_safe(path, MAX_DIMENSION if draft else None)
+    decoded_size = img.size
+    width, height = img.size
+    maxdim = max(width, height)
+    if maxdim > MAX_DIMENSION:
+        scale = MAX_DIMENSION / maxdim
+        img = img.resize((int(width * scale), int(height * scale)), Image.LANCZOS)
+    return decoded_size, img.size
+
+def run_mode(files, draft: bool, repeat: int) -> dict:
+    """Runs in its own process so ru_maxrss reflects only this mode."""
+    base = peak_rss_mb()
+    times = []
+    decoded = out = None
+    for _ in range(repeat):
+        for f in files:
+            t0 = time.perf_counter()
+            decoded, out = decode_and_resize(f, draft)
+            times.append(time.perf_counter() - t0)
+    return {
+        "mode": "draft" if draft else "full",
+        "median_ms": round(statistics.median(times) * 1000, 1),
+        "decoded_size": decoded,
+        "output_size": out,
+        "decoded_mb": round(decoded[0] * decoded[1] * 3 / 1e6, 1),
+        "peak_rss_delta_mb": round(peak_rss_mb() - base, 1),
+    }
+
+def run_benchmark(files, repeat: int = REPEAT) -> list:
+    results = []
+    for draft in (False, True):
+        with ProcessPoolExecutor(max_workers=1) as ex:
+            results.append(ex.submit(run_mode, files, draft, repeat).result())
+    return results
+
+def print_table(results):
+    print(f"{'mode':<7}{'median':>10}{'decoded at':>14}{'pixels MB':>11}{'peak RSS +MB':>14}")
+    for r in results:
+        w, h = r["decoded_size"]
+        print(f"{r['mode']:<7}{r['median_ms']:>8.1f}ms{f'{w}x{h}':>14}{r['decoded_mb']:>11.1f}"
+              f"{r['peak_rss_delta_mb']:>14.1f}")
+    full, draft = results
+    if draft["median_ms"]:
+        print(f"\nDraft decoding: {full['median_ms'] / draft['median_ms']:.1f}x faster, "
+              f"{full['decoded_mb'] / draft['decoded_mb']:.1f}x fewer decoded pixels")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark full vs draft JPEG decoding for the image optimizer.")
+    parser.add_argument("files", nargs="*", help="JPEGs to decode (default: a synthetic 24 MP photo)")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--out", help="write the results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        files = [Path(f) for f in args.files]
+        if not files:
+            files = [Path(tmp) / "synthetic.jpg"]
+            synthetic_jpeg(files[0])
+            print(f"Synthetic {SYNTHETIC_SIZE[0]}x{SYNTHETIC_SIZE[1]} JPEG, "
+                  f"{files[0].stat().st_size / 1e6:.1f} MB, target {MAX_DIMENSION} px\n")
+        results = run_benchmark(files, args.repeat)
+
+    print_table(results)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "repeat": args.repeat,
+                       "files": [str(f) for f in files], "results": results}, f, indent=2)
+        print(f"Results written to {args.out}")
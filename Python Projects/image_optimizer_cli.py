@@ -1,121 +1,337 @@
 """
 CLI Image Optimizer
 Usage:
-    python image_optimizer_cli.py <file_or_folder1> <file_or_folder2> ...
+    python image_optimizer_cli.py <file_or_folder1> <file_or_folder2> ... [--jobs N] [--force]
+    python image_optimizer_cli.py photos/ --sizes 320,640,1280,1920   # srcset renditions
+    python image_optimizer_cli.py photos/ --target-kb 150 --min-ssim 0.95  # per-file quality search
+    python image_optimizer_cli.py uploads/ --dedupe -j 8   # optimize one copy per near-duplicate group
+    python image_optimizer_cli.py dropbox/ --watch -j 4    # keep optimized/ in sync as files land
+    python image_optimizer_cli.py photos/ --report run.json   # per-stage timing table + JSON report
+    python image_optimizer_cli.py client.zip --archive-out client-optimized.zip   # archive in, archive out
+Re-runs only process images that changed since the last run (or when the
+settings changed); see the manifest kept in each optimized/ folder.
+.zip/.tar/.tar.gz inputs are read in memory without extracting them; their outputs go to
+optimized/<archive name>/ next to the archive, or with --archive-out into one output archive.
+The optimization itself lives in image_optimizer_engine.py (shared with the GUI).
 """
 
+import os
 import sys
+import time
+import argparse
+import itertools
+from collections import deque
 from pathlib import Path
-from slugify import slugify
-from PIL import Image, ImageOps, ImageFile
-ImageFile.LOAD_TRUNCATED_IMAGES = True
 
-# Optional plugins for HEIC/AVIF
-try:
-    import pillow_heif
-    pillow_heif.register_heif_opener()
-except:
-    pass
+from image_optimizer_engine import (OptimizerConfig, ARCHIVE_SUFFIXES, EXECUTORS, OUTPUT_DIR, DUP_DISTANCE,
+                                    ArchiveMember, Manifests, archive_kind, build_report, find_duplicates, format_bytes,
+                                    gather_files, is_image_file, iter_image_entries, make_executor, np, optimize_image,
+                                    optimize_stream, print_report, reread_members, write_duplicates_report, write_report,
+                                    write_srcset_manifests)
+
 try:
-    import avif
-except:
-    pass
+    from inotify_simple import INotify, flags as inotify_flags  # Linux only; --watch polls without it
+except ImportError:
+    INotify = None
+
+DUP_REPORT = "duplicates.json"
+WATCH_INTERVAL = 2.0          # --watch: seconds between scans; a file must keep its size this long before it is processed
 
-MAX_DIMENSION = 1920
-JPEG_QUALITY = 85
-WEBP_QUALITY = 80
-WEBP_LOSSLESS = False
-CREATE_BOTH = True
-SUPPORTED_EXTS = {'.jpg', '.jpeg', '.png', '.webp', '.heic', '.heif', '.avif', '.gif', '.tiff', '.bmp'}
+def print_summary(results, elapsed: float):
+    damaged = [r["src"] for r in results if isinstance(r["src"], ArchiveMember) and r["src"].error]
+    results = [r for r in results if not (isinstance(r["src"], ArchiveMember) and r["src"].error)]
+    ok = [r for r in results if r["ok"]]
+    rate = len(results) / elapsed if elapsed > 0 else 0.0
+    print(f"\n{len(ok)}/{len(results)} images optimized in {elapsed:.1f}s ({rate:.1f} images/sec)")
+    for fmt in ("jpg", "webp"):
+        done = [r for r in ok if fmt in r["out_bytes"]]
+        if not done:
+            continue
+        src = sum(r["in_bytes"] for r in done)
+        out = sum(r["out_bytes"][fmt] for r in done)
+        pct = (1 - out / src) * 100 if src else 0.0
+        print(f"  {fmt.upper():<5} {format_bytes(src)} -> {format_bytes(out)}  (saved {format_bytes(src - out)}, {pct:.1f}%)")
+    over = sum(1 for r in ok if r["over_budget"])
+    if over:
+        print(f"  {over} image(s) still over the --target-kb budget (see the WARNING lines)")
+    for src in damaged:
+        print(f"  {src.archive.name} could not be read to the end (see the ERROR lines)")
 
-def ensure_out_folder(src_path: Path) -> Path:
-    out_dir = src_path.parent / 'optimized'
-    out_dir.mkdir(parents=True, exist_ok=True)
-    return out_dir
+# ---------- Watch mode ----------
+def scan_images(root: Path, snapshot: dict):
+    """Fills snapshot {path: (size, mtime_ns)} for every image below root (optimized/ folders skipped)."""
+    for entry in iter_image_entries(root):
+        try:
+            st = entry.stat()  # cached by scandir on Windows, one stat elsewhere
+        except OSError:
+            continue
+        snapshot[Path(entry.path)] = (st.st_size, st.st_mtime_ns)
 
-def is_image_file(p: Path) -> bool:
-    return p.suffix.lower() in SUPPORTED_EXTS
+class PollingSource:
+    """Diffs an os.scandir snapshot of the tree, at most once per WATCH_INTERVAL."""
 
-def slugify_name(p: Path) -> str:
-    return slugify(p.stem)
+    name = "polling"
 
-def open_image_safe(path: Path):
-    try:
-        img = Image.open(path)
-        img = ImageOps.exif_transpose(img)
-        return img
-    except:
-        return None
-
-def convert_alpha_to_background(img: Image.Image, bg_color=(255,255,255)):
-    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
-        background = Image.new("RGB", img.size, bg_color)
-        background.paste(img, mask=img.split()[-1])
-        return background
-    else:
-        return img.convert("RGB")
-
-def optimize_image(src: Path):
-    img = open_image_safe(src)
-    if img is None:
-        print(f"SKIP {src.name}: Unsupported or corrupted image")
-        return
+    def __init__(self, roots):
+        self.roots = roots
+        self.snapshot = {}
+        self.last_scan = None
+
+    def poll(self, timeout: float):
+        """Returns (changed paths, deleted paths) since the previous call."""
+        if self.last_scan is not None:
+            time.sleep(timeout)
+            if time.monotonic() - self.last_scan < WATCH_INTERVAL:
+                return set(), set()
+        self.last_scan = time.monotonic()
+        current = {}
+        for root in self.roots:
+            scan_images(root, current)
+        changed = {p for p, sig in current.items() if self.snapshot.get(p) != sig}
+        deleted = set(self.snapshot) - set(current)
+        self.snapshot = current
+        return changed, deleted
+
+class InotifySource:
+    """Kernel change events (Linux); directories are watched recursively as they appear."""
+
+    name = "inotify"
+
+    def __init__(self, roots):
+        self.inotify = INotify()
+        self.dirs = {}
+        self.initial = {}
+        for root in roots:
+            self.watch_tree(root)
+            scan_images(root, self.initial)
+
+    def watch_tree(self, root: Path):
+        mask = (inotify_flags.CREATE | inotify_flags.CLOSE_WRITE | inotify_flags.MOVED_TO |
+                inotify_flags.MOVED_FROM | inotify_flags.DELETE)
+        for dirpath, dirnames, _ in os.walk(root):
+            dirnames[:] = [d for d in dirnames if d != OUTPUT_DIR]
+            try:
+                self.dirs[self.inotify.add_watch(dirpath, mask)] = Path(dirpath)
+            except OSError:
+                continue
 
-    # resize large images
-    width, height = img.size
-    maxdim = max(width, height)
-    if maxdim > MAX_DIMENSION:
-        scale = MAX_DIMENSION / maxdim
-        img = img.resize((int(width*scale), int(height*scale)), Image.LANCZOS)
+    def poll(self, timeout: float):
+        if self.initial is not None:
+            changed, self.initial = set(self.initial), None
+            return changed, set()
+        changed, deleted = set(), set()
+        for ev in self.inotify.read(timeout=int(timeout * 1000)):
+            if ev.mask & inotify_flags.IGNORED:
+                self.dirs.pop(ev.wd, None)
+                continue
+            base = self.dirs.get(ev.wd)
+            if base is None or not ev.name:
+                continue
+            path = base / ev.name
+            if ev.mask & inotify_flags.ISDIR:
+                if ev.name == OUTPUT_DIR:
+                    continue
+                if ev.mask & (inotify_flags.CREATE | inotify_flags.MOVED_TO):
+                    self.watch_tree(path)
+                    found = {}
+                    scan_images(path, found)
+                    changed.update(found)
+                else:
+                    deleted.add(path)  # moved/removed folder: everything below it is gone
+            elif is_image_file(path):
+                if ev.mask & (inotify_flags.DELETE | inotify_flags.MOVED_FROM):
+                    deleted.add(path)
+                    changed.discard(path)
+                else:
+                    changed.add(path)
+        return changed, deleted
 
-    rgb_img = convert_alpha_to_background(img)
+def watch(inputs, config: OptimizerConfig, jobs: int = 1):
+    """
+    Daemon mode: processes new or modified images once their size has stopped changing
+    for WATCH_INTERVAL, and removes the outputs of deleted sources. Runs until Ctrl+C.
+    """
+    roots = [Path(p) for p in inputs if Path(p).is_dir()]
+    if not roots:
+        print("--watch needs at least one folder.")
+        return
+    source = InotifySource(roots) if INotify else PollingSource(roots)
+    print(f"Watching {', '.join(map(str, roots))} ({source.name}); Ctrl+C to stop.")
 
-    base_slug = slugify_name(src)
-    out_dir = ensure_out_folder(src)
+    manifests = Manifests()
+    settings = config.signature()
+    known = set()           # every source seen, to expand deletes of whole folders
+    candidates = {}         # path -> ((size, mtime_ns), first seen) while waiting for the copy to finish
+    queued = deque()
+    pending = {}            # future -> path
+    limit = max(1, jobs) * 4
 
-    # Save JPG
+    ex = make_executor("process", jobs, ignore_sigint=True)
     try:
-        jpg_path = out_dir / f"{base_slug}.jpg"
-        rgb_img.save(jpg_path, format='JPEG', quality=JPEG_QUALITY, optimize=True)
-        print(f"Saved JPG: {jpg_path}")
-    except Exception as e:
-        print(f"ERROR JPG {src.name}: {e}")
-
-    # Save WEBP
-    if CREATE_BOTH:
-        try:
-            webp_path = out_dir / f"{base_slug}.webp"
-            rgb_img.save(webp_path, format='WEBP', quality=WEBP_QUALITY, lossless=WEBP_LOSSLESS, optimize=True)
-            print(f"Saved WEBP: {webp_path}")
-        except Exception as e:
-            print(f"ERROR WEBP {src.name}: {e}")
-
-def gather_files(inputs):
-    files = []
-    for item in inputs:
-        p = Path(item)
-        if p.is_dir():
-            for f in p.rglob('*'):
-                if f.is_file() and is_image_file(f):
-                    files.append(f)
-        elif p.is_file():
-            if is_image_file(p):
-                files.append(p)
-    return sorted(list(dict.fromkeys(files)))
+        while True:
+            changed, deleted = source.poll(0.25 if pending or candidates else WATCH_INTERVAL)
+
+            removed = []
+            for d in deleted:
+                for p in {d} | {p for p in known if d in p.parents}:
+                    known.discard(p)
+                    candidates.pop(p, None)
+                    if p in queued:
+                        queued.remove(p)
+                    count = manifests.remove_outputs(p)
+                    if count:
+                        print(f"Removed {count} outputs of deleted {p.name}")
+                        removed.append(p)
+            for p in changed:
+                known.add(p)
+                candidates[p] = None
+
+            now = time.monotonic()
+            in_progress = set(pending.values()) | set(queued)
+            for p, seen in list(candidates.items()):
+                try:
+                    st = p.stat()
+                except OSError:
+                    del candidates[p]
+                    continue
+                sig = (st.st_size, st.st_mtime_ns)
+                if seen is None or seen[0] != sig:
+                    candidates[p] = (sig, now)
+                    continue
+                if now - seen[1] < WATCH_INTERVAL or p in in_progress:
+                    continue  # still being written, or wait until the running job is done
+                del candidates[p]
+                if not manifests.for_source(p).is_up_to_date(p, st, settings):
+                    queued.append(p)
+
+            while queued and len(pending) < limit:
+                p = queued.popleft()
+                pending[ex.submit(optimize_image, p, config)] = p
+
+            results = []
+            for fut in [f for f in pending if f.done()]:
+                p = pending.pop(fut)
+                result = fut.result()
+                if not p.exists():
+                    # deleted while its job ran: the delete found nothing to remove yet
+                    manifests.record(result, settings)
+                    count = manifests.remove_outputs(p)
+                    if count:
+                        print(f"Removed {count} outputs of deleted {p.name}")
+                    removed.append(p)
+                    continue
+                for line in result["lines"]:
+                    print(line)
+                results.append(result)
+                manifests.record(result, settings)
+            if results or removed:
+                manifests.save()
+                if config.renditions:
+                    write_srcset_manifests(results, removed)
+    except KeyboardInterrupt:
+        print("\nStopping watch...")
+    finally:
+        ex.shutdown(wait=True, cancel_futures=True)
+        manifests.save()
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python image_optimizer_cli.py <file_or_folder1> <file_or_folder2> ...")
-        sys.exit(1)
+    defaults = OptimizerConfig()
+    parser = argparse.ArgumentParser(description="Optimize images into <folder>/optimized/ as JPG and WEBP.")
+    parser.add_argument("inputs", nargs="+", metavar="file_or_folder")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help=f"parallel workers (this machine has {os.cpu_count()} cores)")
+    parser.add_argument("--executor", choices=EXECUTORS,
+                        help="how to run the workers (default: process with --jobs > 1, else serial)")
+    parser.add_argument("--force", action="store_true", help="re-optimize even unchanged images")
+    parser.add_argument("--sorted", action="store_true",
+                        help="list all files first and process them in path order (default: start as files are found)")
+    parser.add_argument("--max-dimension", type=int, default=defaults.max_dimension)
+    parser.add_argument("--jpeg-quality", type=int, default=defaults.jpeg_quality)
+    parser.add_argument("--webp-quality", type=int, default=defaults.webp_quality)
+    parser.add_argument("--webp-lossless", action="store_true")
+    parser.add_argument("--jpg-only", action="store_true", help="skip the WEBP outputs")
+    parser.add_argument("--sizes", help="comma-separated long-side sizes for srcset renditions, e.g. 320,640,1280,1920")
+    parser.add_argument("--target-kb", type=float, help="per-file size budget; binary-searches JPG/WEBP quality")
+    parser.add_argument("--min-ssim", type=float, help="never let the quality search go below this SSIM (needs numpy)")
+    parser.add_argument("--min-psnr", type=float, help="never let the quality search go below this PSNR in dB")
+    parser.add_argument("--dedupe", action="store_true",
+                        help="skip near-duplicate copies (perceptual hash), keeping the largest of each group")
+    parser.add_argument("--dup-distance", type=int, default=DUP_DISTANCE, help="max differing bits of 64 (default %(default)s)")
+    parser.add_argument("--dup-report", default=DUP_REPORT, help="where to write the duplicate groups (default %(default)s)")
+    parser.add_argument("--report", metavar="JSON", help="write per-stage timings to JSON and print a stage table")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running: optimize new/changed images as they land and mirror deletes")
+    parser.add_argument("--archive-out", metavar="ARCHIVE",
+                        help="write all outputs into this .zip/.tar/.tar.gz instead of optimized/ folders")
+    parser.add_argument("--read-ahead", type=int, metavar="N",
+                        help="max images read ahead of the workers (default: 4 per job, 8 per job for --dedupe hashing)")
+    args = parser.parse_args()
+    if args.archive_out and args.watch:
+        parser.error("--archive-out can't be combined with --watch")
+    if args.archive_out and not archive_kind(Path(args.archive_out)):
+        parser.error(f"--archive-out must end in one of {', '.join(ARCHIVE_SUFFIXES)}")
+    if args.min_ssim is not None and np is None:
+        parser.error("--min-ssim needs numpy (pip install numpy), or use --min-psnr")
+    renditions = ()
+    if args.sizes:
+        try:
+            renditions = tuple(sorted({int(s) for s in args.sizes.split(",") if s.strip()}))
+        except ValueError:
+            parser.error(f"--sizes must be comma-separated pixel sizes, e.g. 320,640,1280 (got {args.sizes!r})")
+        if not renditions or renditions[0] < 1:
+            parser.error("--sizes must be positive integers")
+
+    config = defaults._replace(
+        max_dimension=args.max_dimension, jpeg_quality=args.jpeg_quality, webp_quality=args.webp_quality,
+        webp_lossless=args.webp_lossless, create_both=not args.jpg_only, renditions=renditions,
+        target_kb=args.target_kb, min_ssim=args.min_ssim, min_psnr=args.min_psnr)
+    executor = args.executor or ("process" if args.jobs > 1 else "serial")
 
-    input_paths = sys.argv[1:]
-    files_to_process = gather_files(input_paths)
-    if not files_to_process:
+    if args.watch:
+        watch(args.inputs, config, args.jobs)
+        sys.exit(0)
+
+    # streamed: the first images are being optimized while the tree is still being listed
+    all_files = gather_files(args.inputs, sort=args.sorted)
+    first = next(all_files, None)
+    if first is None:
         print("No valid image files found.")
         sys.exit(0)
+    all_files = itertools.chain([first], all_files)
+
+    if args.dedupe:
+        t0 = time.perf_counter()
+        all_files, groups = find_duplicates(all_files, executor, args.jobs, args.dup_distance, args.read_ahead)
+        all_files = reread_members(all_files)  # kept archive members come back without their bytes
+        write_duplicates_report(groups, args.dup_report, args.dup_distance)
+        copies = sum(len(g["duplicates"]) for g in groups)
+        print(f"Hashed in {time.perf_counter() - t0:.1f}s: {len(groups)} duplicate groups, "
+              f"skipping {copies} copies (see {args.dup_report}).")
 
-    print(f"Processing {len(files_to_process)} images...")
-    for f in files_to_process:
-        optimize_image(f)
+    print("Processing images...")
+    t0 = time.perf_counter()
+    results = []
+    skipped = 0
+    for result in optimize_stream(all_files, config, executor, args.jobs, force=args.force,
+                                  max_in_flight=args.read_ahead, archive_out=args.archive_out):
+        if result["skipped"]:
+            skipped += 1
+            continue
+        for line in result["lines"]:
+            print(line)
+        result.pop("lines")
+        results.append(result)
+    if skipped:
+        print(f"Skipped {skipped} unchanged images.")
+    if results:
+        elapsed = time.perf_counter() - t0
+        print_summary(results, elapsed)
+        if args.report:
+            report = build_report(results, elapsed)
+            print_report(report)
+            write_report(report, args.report)
+            print(f"Report written to {args.report}")
+    if args.archive_out:
+        print(f"Outputs written to {args.archive_out}")
 
     print("Done!")
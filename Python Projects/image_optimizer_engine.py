@@ -0,0 +1,1089 @@
+"""
+image_optimizer_engine.py
+Shared optimization engine behind image_optimizer_cli.py and image_optimizer_gui.py:
+- OptimizerConfig: every setting in one (picklable) object instead of module globals
+- optimize_image(): one source -> JPG/WEBP in <folder>/optimized/ (srcset renditions,
+  byte-budget quality search and per-stage timings included), never raises
+- optimize_stream(): yields result records as files finish, on a serial, thread or
+  process executor, skipping unchanged files via the manifest in each optimized/ folder
+- .zip/.tar(.gz) inputs read member by member in memory, and optionally every output
+  written straight into one output archive (no intermediate files)
+- Near-duplicate detection, srcset.json and stage reports
+Usage:
+    from image_optimizer_engine import OptimizerConfig, gather_files, optimize_stream
+    for result in optimize_stream(gather_files(["photos"]), OptimizerConfig(), "process", jobs=4):
+        print(result["src"], result["ok"])
+"""
+
+import io
+import os
+import json
+import math
+import time
+import signal
+import hashlib
+import tarfile
+import itertools
+import zipfile
+from concurrent.futures import (Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor,
+                                FIRST_COMPLETED, wait)
+from contextlib import contextmanager
+from pathlib import Path, PurePosixPath
+from typing import NamedTuple, Optional, Tuple
+from slugify import slugify
+from PIL import Image, ImageOps, ImageFile, ImageChops, ImageStat
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+try:
+    import numpy as np  # only needed for min_ssim
+except ImportError:
+    np = None
+
+# Optional plugins for HEIC/AVIF
+try:
+    import pillow_heif
+    pillow_heif.register_heif_opener()
+except Exception:
+    pass
+try:
+    import avif
+except Exception:
+    pass
+
+# ---------- Config ----------
+SUPPORTED_EXTS = frozenset({'.jpg', '.jpeg', '.png', '.webp', '.heic', '.heif', '.avif', '.gif', '.tiff', '.bmp'})
+OUTPUT_DIR = 'optimized'
+ARCHIVE_SUFFIXES = ('.tar.gz', '.tgz', '.tar', '.zip')
+MANIFEST_NAME = ".optimize-manifest.json"
+MANIFEST_VERSION = 1
+SRCSET_MANIFEST = "srcset.json"
+STAGE_ORDER = ("hash", "decode", "exif_transpose", "resize", "alpha", "save_jpg", "save_webp")
+SLOWEST_FILES = 10            # how many files a stage report lists
+HASH_SIZE = 8                 # dHash of a (HASH_SIZE+1) x HASH_SIZE thumbnail = 64 bits
+DUP_DISTANCE = 5              # max differing hash bits for two images to count as near-duplicates
+
+class OptimizerConfig(NamedTuple):
+    max_dimension: int = 1920          # resize larger images to this max width/height
+    jpeg_quality: int = 85             # 0-100
+    webp_quality: int = 80             # 0-100
+    webp_lossless: bool = False
+    create_both: bool = True           # JPG and WEBP; False = JPG only
+    renditions: Tuple[int, ...] = ()   # long-side sizes for srcset, e.g. (320, 640, 1280, 1920); () = one output
+    encode_threads: int = 4            # JPG/WEBP encoders run concurrently (Pillow releases the GIL while encoding)
+    target_kb: Optional[float] = None  # per-file byte budget: binary-search the quality instead of the fixed values
+    min_ssim: Optional[float] = None   # quality floor for the search, e.g. 0.95 (needs numpy)
+    min_psnr: Optional[float] = None   # alternative floor in dB, e.g. 38 (Pillow only)
+    quality_range: Tuple[int, int] = (30, 95)
+    bg_color: Tuple[int, int, int] = (255, 255, 255)   # what transparent pixels become
+
+    @property
+    def quality_search(self) -> bool:
+        return bool(self.target_kb) or self.min_ssim is not None or self.min_psnr is not None
+
+    def output_formats(self):
+        formats = [("jpg", "JPEG", dict(quality=self.jpeg_quality, optimize=True))]
+        if self.create_both:
+            formats.append(("webp", "WEBP", dict(quality=self.webp_quality, lossless=self.webp_lossless,
+                                                 optimize=True)))
+        return formats
+
+    def signature(self) -> str:
+        # any change here means every output has to be rebuilt
+        return json.dumps({"max_dimension": self.max_dimension, "jpeg_quality": self.jpeg_quality,
+                           "webp_quality": self.webp_quality, "webp_lossless": self.webp_lossless,
+                           "create_both": self.create_both, "renditions": sorted(self.renditions),
+                           "target_kb": self.target_kb, "min_ssim": self.min_ssim, "min_psnr": self.min_psnr,
+                           "quality_range": list(self.quality_range) if self.quality_search else None,
+                           "bg_color": list(self.bg_color)},
+                          sort_keys=True)
+
+# ---------- Helpers ----------
+def ensure_out_folder(src_path: Path) -> Path:
+    out_dir = output_dir(src_path)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    return out_dir
+
+def is_image_file(p: Path) -> bool:
+    return p.suffix.lower() in SUPPORTED_EXTS
+
+def is_image_name(name: str) -> bool:
+    return os.path.splitext(name)[1].lower() in SUPPORTED_EXTS
+
+def slugify_name(p: Path) -> str:
+    return slugify(p.stem)
+
+def format_bytes(n: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(n) < 1024 or unit == "GB":
+            return f"{n:.1f} {unit}" if unit != "B" else f"{int(n)} B"
+        n /= 1024
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+class StageTimer:
+    """Accumulates wall time per stage: with timer("resize"): ...  (seconds in .stages)."""
+
+    def __init__(self):
+        self.stages = {}
+        self.megapixels = 0.0
+
+    def add(self, name: str, seconds: float):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    @contextmanager
+    def __call__(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+# ---------- Archives ----------
+class ArchiveMember(NamedTuple):
+    """
+    An image inside a .zip/.tar(.gz) input; data holds its bytes (empty in result records).
+    error is only set on the stand-in iter_archive yields for an archive it couldn't read
+    to the end; optimizing it fails with that message.
+    """
+    archive: Path
+    member: str
+    data: bytes = b""
+    error: str = ""
+
+    @property
+    def name(self) -> str:
+        return PurePosixPath(self.member).name
+
+    @property
+    def stem(self) -> str:
+        return PurePosixPath(self.member).stem
+
+    def __str__(self):
+        return f"{self.archive}:{self.member}"
+
+def archive_kind(p: Path) -> Optional[str]:
+    """The archive suffix of p (one of ARCHIVE_SUFFIXES), or None if it isn't an archive."""
+    name = p.name.lower()
+    return next((suffix for suffix in ARCHIVE_SUFFIXES if name.endswith(suffix)), None)
+
+def archive_stem(p: Path) -> str:
+    return p.name[:len(p.name) - len(archive_kind(p) or "")]
+
+def member_folder(member: str):
+    """Folder parts of a member name, without absolute or '..' parts (nothing escapes optimized/)."""
+    parts = PurePosixPath(member.replace("\\", "/")).parent.parts
+    return [part for part in parts if part not in ("/", ".", "..")]
+
+def output_dir(src) -> Path:
+    """optimized/ next to a file; optimized/<archive name>/<member folder> for an archive member."""
+    if isinstance(src, ArchiveMember):
+        return src.archive.parent.joinpath(OUTPUT_DIR, archive_stem(src.archive), *member_folder(src.member))
+    return src.parent / OUTPUT_DIR
+
+def archive_folder(src) -> PurePosixPath:
+    """Folder of a source's outputs inside an output archive: <archive name>/<member folder>, else the source's folder name."""
+    if isinstance(src, ArchiveMember):
+        return PurePosixPath(archive_stem(src.archive), *member_folder(src.member))
+    return PurePosixPath(src.resolve().parent.name)
+
+def open_source(src):
+    """What Image.open() should read: the path, or the member's bytes for an archive member."""
+    return io.BytesIO(src.data) if isinstance(src, ArchiveMember) else src
+
+def source_ref(src):
+    """The source without an archive member's bytes, for records that outlive the work on it."""
+    return src._replace(data=b"") if isinstance(src, ArchiveMember) else src
+
+def reread_members(sources):
+    """
+    Yields the sources again with archive members' bytes re-read (e.g. after find_duplicates,
+    which only keeps references): files first, then each archive's wanted members in one pass.
+    """
+    wanted = {}
+    for src in sources:
+        if isinstance(src, ArchiveMember):
+            wanted.setdefault(src.archive, set()).add(src.member)
+        else:
+            yield src
+    for archive, members in wanted.items():
+        for member in iter_archive(archive):
+            if member.member in members:
+                yield member
+
+def source_size(src) -> int:
+    return len(src.data) if isinstance(src, ArchiveMember) else src.stat().st_size
+
+class _StrictTarInfo(tarfile.TarInfo):
+    """TarFile.next() takes a damaged header after the first member for the end of the archive; raise instead."""
+
+    @classmethod
+    def fromtarfile(cls, tf):
+        try:
+            return super().fromtarfile(tf)
+        except (tarfile.InvalidHeaderError, tarfile.TruncatedHeaderError) as e:
+            raise tarfile.ReadError(f"damaged member header ({e})") from None
+
+def iter_archive(path: Path):
+    """
+    Yields an ArchiveMember for every image in a .zip/.tar(.gz), in archive order, reading
+    one member at a time into memory (nothing is extracted to disk). Tars are read as a
+    stream, so a .tar.gz is decompressed exactly once. A member that can't be read is
+    yielded with empty data and reported by the optimizer. If the archive itself is
+    damaged, reading stops there and a last ArchiveMember carries the error, so the
+    failure (and how many images were read before it) shows up as an error result.
+    """
+    read = 0
+    try:
+        if archive_kind(path) == '.zip':
+            with zipfile.ZipFile(path) as zf:
+                for info in zf.infolist():
+                    if info.is_dir() or not is_image_name(info.filename):
+                        continue
+                    try:
+                        data = zf.read(info)
+                    except Exception:  # encrypted, bad CRC, unsupported compression
+                        data = b""
+                    yield ArchiveMember(path, info.filename, data)
+                    read += 1
+        else:
+            with tarfile.open(path, "r|*", tarinfo=_StrictTarInfo) as tf:
+                for info in tf:
+                    if info.isfile() and is_image_name(info.name):
+                        yield ArchiveMember(path, info.name, tf.extractfile(info).read())
+                        read += 1
+    except (OSError, EOFError, zipfile.BadZipFile, tarfile.TarError) as e:
+        where = f"stopped after {read} images" if read else "no images could be read"
+        yield ArchiveMember(path, path.name, error=f"damaged archive, {where}: {e}")
+
+class ArchiveWriter:
+    """
+    Output .zip/.tar(.gz) that results are written into as they finish. The outputs are
+    already-compressed images, so zip entries are stored rather than deflated. The archive
+    is built as <name>.part and only renamed into place by close(complete=True); an
+    interrupted or failed run discards it, so the final name never holds a partial archive.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.kind = archive_kind(self.path)
+        if self.kind is None:
+            raise ValueError(f"Unsupported output archive {self.path.name}, expected one of {ARCHIVE_SUFFIXES}")
+        self.tmp = self.path.with_name(self.path.name + ".part")
+        if self.kind == '.zip':
+            self.archive = zipfile.ZipFile(self.tmp, "w", zipfile.ZIP_STORED)
+        else:
+            self.archive = tarfile.open(self.tmp, "w" if self.kind == '.tar' else "w:gz")
+        self.names = set()
+
+    def write(self, name: str, data: bytes) -> bool:
+        """Adds one file; returns False (and writes nothing) if the name is already taken."""
+        if name in self.names:
+            return False
+        self.names.add(name)
+        if self.kind == '.zip':
+            self.archive.writestr(name, data)
+        else:
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime = len(data), time.time()
+            self.archive.addfile(info, io.BytesIO(data))
+        return True
+
+    def add_result(self, result: dict):
+        """Moves a result's encoded outputs into the archive (the bytes are dropped from the record)."""
+        for name, data in result.pop("files", []):
+            if not self.write(name, data):
+                result["ok"] = False
+                add_error(result, f"ERROR {result['src'].name}: {name} is already in {self.path.name}")
+
+    def write_srcset(self, results):
+        """srcset.json per output folder inside the archive (same format as write_srcset_manifests)."""
+        by_dir = {}
+        for r in results:
+            by_dir.setdefault(archive_folder(r["src"]), {})[r["src"].name] = sorted(
+                r["renditions"], key=lambda o: (o["format"], o["width"]))
+        for folder, data in by_dir.items():
+            self.write((folder / SRCSET_MANIFEST).as_posix(), json.dumps(data, indent=2).encode("utf-8"))
+
+    def close(self, complete: bool = True):
+        self.archive.close()
+        if complete:
+            os.replace(self.tmp, self.path)
+        else:
+            self.tmp.unlink(missing_ok=True)
+
+# ---------- Decode / resize ----------
+def draft_size(size, max_dim: int):
+    """Smallest size that still keeps the long side >= max_dim (None if no downscale is needed)."""
+    width, height = size
+    maxdim = max(width, height)
+    if maxdim <= max_dim:
+        return None
+    scale = max_dim / maxdim
+    return (max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale)))
+
+def open_image_safe(path: Path, max_dim: int = None, timer: StageTimer = None):
+    """
+    With max_dim set, JPEGs are decoded straight at the largest 1/2, 1/4 or 1/8 DCT
+    scale that is still at least max_dim on the long side (Image.draft), so a 24 MP
+    photo is never fully decoded just to be shrunk to 1920 px.
+    """
+    timer = timer or StageTimer()
+    try:
+        with timer("decode"):
+            img = Image.open(path)
+            timer.megapixels = img.width * img.height / 1e6
+            if max_dim and img.format == 'JPEG':
+                target = draft_size(img.size, max_dim)
+                if target:
+                    img.draft(None, target)
+            img.load()
+        with timer("exif_transpose"):
+            img = ImageOps.exif_transpose(img)
+        return img
+    except Exception:
+        return None
+
+def convert_alpha_to_background(img: Image.Image, bg_color=(255,255,255)):
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        background = Image.new("RGB", img.size, bg_color)
+        background.paste(img, mask=img.split()[-1])  # paste with alpha channel as mask
+        return background
+    else:
+        return img.convert("RGB")
+
+def rendition_cascade(img: Image.Image, sizes):
+    """
+    Yields (label, image) from the largest size down, each resized from the previous
+    one instead of from the source. Sizes at or above the source collapse into a single
+    rendition at native size; images are never upscaled.
+    """
+    native = max(img.size)
+    sizes = sorted({min(s, native) for s in sizes}, reverse=True)
+    for size in sizes:
+        width, height = img.size
+        if size < max(width, height):
+            scale = size / max(width, height)
+            img = img.resize((max(1, int(width*scale)), max(1, int(height*scale))), Image.LANCZOS)
+        yield size, img
+
+# ---------- Quality search ----------
+def ssim(a: Image.Image, b: Image.Image, win: int = 8) -> float:
+    """Mean SSIM of the luma channels over win x win windows (box filter via integral images)."""
+    x = np.asarray(a.convert("L"), dtype=np.float64)
+    y = np.asarray(b.convert("L"), dtype=np.float64)
+    if min(x.shape) < win:
+        win = min(x.shape)
+
+    def local_mean(z):
+        c = np.pad(z.cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+        return (c[win:, win:] - c[:-win, win:] - c[win:, :-win] + c[:-win, :-win]) / (win * win)
+
+    mx, my = local_mean(x), local_mean(y)
+    vx = local_mean(x * x) - mx * mx
+    vy = local_mean(y * y) - my * my
+    cov = local_mean(x * y) - mx * my
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    s = ((2 * mx * my + c1) * (2 * cov + c2)) / ((mx * mx + my * my + c1) * (vx + vy + c2))
+    return float(s.mean())
+
+def psnr(a: Image.Image, b: Image.Image) -> float:
+    diff = ImageChops.difference(a.convert("RGB"), b.convert("RGB"))
+    mse = sum(ImageStat.Stat(diff).sum2) / (a.width * a.height * 3)
+    return float("inf") if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+def encode_to_bytes(img: Image.Image, fmt: str, params: dict) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **params)
+    return buf.getvalue()
+
+def search_quality(img: Image.Image, fmt: str, params: dict, config: OptimizerConfig):
+    """
+    Picks the encoder quality for one output, encoding only to memory:
+    - with target_kb: the highest quality whose output fits the budget
+    - with min_ssim / min_psnr: never below the lowest quality that still meets the floor
+      (without a budget, that lowest quality is the answer: smallest acceptable file)
+    The floor wins over the budget. Returns (data, quality, score or None).
+    """
+    lo, hi = config.quality_range
+    has_floor = config.min_ssim is not None or config.min_psnr is not None
+    encoded, scores = {}, {}
+
+    def data(q):
+        if q not in encoded:
+            encoded[q] = encode_to_bytes(img, fmt, dict(params, quality=q))
+        return encoded[q]
+
+    def score(q):
+        if q not in scores:
+            decoded = Image.open(io.BytesIO(data(q)))
+            scores[q] = ssim(img, decoded) if config.min_ssim is not None else psnr(img, decoded)
+        return scores[q]
+
+    def acceptable(q):
+        if not has_floor:
+            return True
+        return score(q) >= (config.min_ssim if config.min_ssim is not None else config.min_psnr)
+
+    # largest quality that fits the budget (output size grows with quality)
+    chosen = hi
+    if config.target_kb:
+        budget = config.target_kb * 1024
+        a, b = lo, hi
+        chosen = lo
+        while a <= b:
+            mid = (a + b) // 2
+            if len(data(mid)) <= budget:
+                chosen, a = mid, mid + 1
+            else:
+                b = mid - 1
+    # raise it to the quality floor if the budget pushed it too low
+    if not acceptable(chosen):
+        a, b = chosen + 1, hi
+        chosen = hi
+        while a <= b:
+            mid = (a + b) // 2
+            if acceptable(mid):
+                chosen, b = mid, mid - 1
+            else:
+                a = mid + 1
+    elif not config.target_kb:
+        # no budget: walk down to the lowest quality that still meets the floor
+        a, b = lo, chosen - 1
+        while a <= b:
+            mid = (a + b) // 2
+            if acceptable(mid):
+                chosen, b = mid, mid - 1
+            else:
+                a = mid + 1
+    return data(chosen), chosen, (score(chosen) if has_floor else None)
+
+def encode_output(img: Image.Image, path, fmt: str, params: dict, config: OptimizerConfig) -> dict:
+    """
+    Writes one output to a path or a binary file object; with a quality search the
+    chosen in-memory encode is written as is.
+    """
+    if not config.quality_search or params.get("lossless"):
+        img.save(path, format=fmt, **params)
+        return {}
+    data, quality, score = search_quality(img, fmt, params, config)
+    if isinstance(path, io.IOBase):
+        path.write(data)
+    else:
+        path.write_bytes(data)
+    info = {"quality": quality}
+    if score is not None:
+        info["ssim" if config.min_ssim is not None else "psnr"] = round(score, 4)
+    return info
+
+def timed_encode(img: Image.Image, path, fmt: str, params: dict, config: OptimizerConfig):
+    t0 = time.perf_counter()
+    info = encode_output(img, path, fmt, params, config)
+    return info, time.perf_counter() - t0
+
+# ---------- Optimize one image ----------
+def new_result(src) -> dict:
+    return {"src": source_ref(src), "ok": False, "skipped": False, "lines": [], "errors": [], "in_bytes": 0,
+            "out_bytes": {}, "outputs": [], "renditions": [], "over_budget": False, "timings": {},
+            "megapixels": 0.0}
+
+def save_variants(src, variants, out_dir, result: dict, config: OptimizerConfig,
+                  timer: StageTimer = None, keep_bytes: bool = False):
+    """
+    Encodes every (label, rgb image) variant to each output format, all encoders running
+    concurrently in threads. Fills result["out_bytes"], ["outputs"], ["renditions"], ["lines"].
+    With keep_bytes nothing is written: out_dir is a folder inside an output archive and
+    the encoded files go to result["files"] as [(archive name, bytes)].
+    save_<format> timings are encoder-thread time, so they can add up to more than wall time.
+    """
+    timer = timer or StageTimer()
+    base_slug = slugify_name(src)
+    jobs = []
+    for label, img in variants:
+        stem = f"{base_slug}-{label}" if label else base_slug
+        for ext, fmt, params in config.output_formats():
+            jobs.append((img, out_dir / f"{stem}.{ext}", io.BytesIO() if keep_bytes else None, ext, fmt, params))
+
+    with ThreadPoolExecutor(max_workers=min(config.encode_threads, len(jobs))) as ex:
+        futures = [ex.submit(timed_encode, img, path if buf is None else buf, fmt, params, config)
+                   for img, path, buf, ext, fmt, params in jobs]
+
+    for (img, path, buf, ext, fmt, params), fut in zip(jobs, futures):
+        try:
+            info, seconds = fut.result()
+            timer.add(f"save_{ext}", seconds)
+            size = path.stat().st_size if buf is None else buf.getbuffer().nbytes
+        except Exception as e:
+            add_error(result, f"ERROR {ext.upper()} {src.name}: {e}")
+            continue
+        if buf is not None:
+            result.setdefault("files", []).append((path.as_posix(), buf.getvalue()))
+        result["out_bytes"][ext] = result["out_bytes"].get(ext, 0) + size
+        result["outputs"].append(path.name)
+        detail = ", ".join(f"{k} {v}" for k, v in info.items())
+        result["lines"].append(f"Saved {ext.upper()}: {path}" + (f" ({format_bytes(size)}, {detail})" if detail else ""))
+        if config.target_kb and size > config.target_kb * 1024:
+            # the search ran out of room: even the lowest quality, the quality floor or lossless is too big
+            info["over_budget"] = True
+            result["over_budget"] = True
+            result["lines"].append(f"WARNING {ext.upper()} {src.name}: {format_bytes(size)} is over the "
+                                   f"{config.target_kb:g} KB budget ({over_budget_reason(info, params, config)})")
+        result["renditions"].append(dict({"file": path.name, "format": ext, "width": img.width,
+                                          "height": img.height, "bytes": size}, **info))
+    return len(result["outputs"]) == len(jobs)
+
+def over_budget_reason(info: dict, params: dict, config: OptimizerConfig) -> str:
+    if params.get("lossless"):
+        return "lossless output"
+    if "quality" in info and info["quality"] > config.quality_range[0]:
+        return f"quality floor kept at {info['quality']}"
+    return f"even at quality {config.quality_range[0]}"
+
+def add_error(result: dict, msg: str):
+    result["lines"].append(msg)
+    result["errors"].append(msg)
+
+def _optimize(src, config: OptimizerConfig, result: dict, keep_bytes: bool = False):
+    timer = StageTimer()
+    result["timings"] = timer.stages
+    try:
+        with timer("hash"):
+            if isinstance(src, ArchiveMember):
+                result["in_bytes"] = len(src.data)  # no stat/hash: members aren't tracked by a manifest
+            else:
+                st = src.stat()
+                result["in_bytes"], result["mtime_ns"] = st.st_size, st.st_mtime_ns
+                result["sha256"] = file_sha256(src)
+    except OSError:
+        pass
+    img = open_image_safe(open_source(src), max(config.renditions) if config.renditions else config.max_dimension, timer)
+    result["megapixels"] = round(timer.megapixels, 2)
+    if img is None:
+        add_error(result, f"SKIP {src.name}: Unsupported or corrupted image")
+        return
+
+    if config.renditions:
+        # flatten alpha once, after the first (largest) resize, then cascade down
+        cascade = rendition_cascade(img, config.renditions)
+        with timer("resize"):
+            label, largest = next(cascade)
+        with timer("alpha"):
+            largest = convert_alpha_to_background(largest, config.bg_color)
+        with timer("resize"):
+            variants = [(label, largest)] + list(
+                rendition_cascade(largest, [s for s in config.renditions if s < label]))
+    else:
+        # resize large images
+        with timer("resize"):
+            width, height = img.size
+            maxdim = max(width, height)
+            if maxdim > config.max_dimension:
+                scale = config.max_dimension / maxdim
+                img = img.resize((int(width*scale), int(height*scale)), Image.LANCZOS)
+        with timer("alpha"):
+            variants = [(None, convert_alpha_to_background(img, config.bg_color))]
+
+    # only complete results go into the manifest, so a failed format is retried next run
+    out_dir = archive_folder(src) if keep_bytes else ensure_out_folder(src)
+    result["ok"] = save_variants(src, variants, out_dir, result, config, timer, keep_bytes)
+
+def optimize_image(src, config: OptimizerConfig = OptimizerConfig(), keep_bytes: bool = False) -> dict:
+    """
+    Optimizes one file (a Path or an ArchiveMember) and returns its result record
+    (never raises, so it is safe in any pool):
+    {"src", "ok", "skipped", "lines" (messages), "errors" (the failures among them),
+     "in_bytes", "out_bytes" {format: bytes}, "outputs" (file names),
+     "renditions" [{file, format, width, height, bytes[, over_budget]}], "over_budget"
+     (some output is still bigger than target_kb), "mtime_ns", "sha256",
+     "timings" {stage: seconds}, "megapixels"}
+    keep_bytes returns the encoded outputs in "files" instead of writing optimized/ folders.
+    EXIF is never carried over to the outputs.
+    """
+    result = new_result(src)
+    try:
+        if isinstance(src, ArchiveMember) and src.error:
+            raise ValueError(src.error)
+        _optimize(src, config, result, keep_bytes)
+    except Exception as e:
+        result["ok"] = False
+        add_error(result, f"ERROR {src.name}: {e}")
+    return result
+
+# ---------- Executors ----------
+class SerialExecutor(Executor):
+    """Runs each task inline on submit(); same interface as the pools, no threads."""
+
+    def submit(self, fn, *args, **kwargs):
+        fut = Future()
+        try:
+            fut.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            fut.set_exception(e)
+        return fut
+
+EXECUTORS = ("serial", "thread", "process")
+
+def _ignore_sigint():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def make_executor(kind: str = "serial", jobs: int = 1, ignore_sigint: bool = False) -> Executor:
+    """
+    serial: one file at a time in this thread.
+    thread: a thread pool; Pillow releases the GIL while decoding/resizing/encoding.
+    process: a process pool; needs the caller's module to be import-safe (a __main__ guard).
+    ignore_sigint: pool processes ignore Ctrl+C, so only the caller handles it
+    (and idle workers don't print KeyboardInterrupt tracebacks).
+    """
+    if kind == "serial":
+        return SerialExecutor()
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=max(1, jobs))
+    if kind == "process":
+        return ProcessPoolExecutor(max_workers=max(1, jobs),
+                                   initializer=_ignore_sigint if ignore_sigint else None)
+    raise ValueError(f"Unknown executor {kind!r}, expected one of {EXECUTORS}")
+
+# ---------- Incremental manifest ----------
+class Manifest:
+    """
+    Per optimized/ folder record of what each source looked like when it was last
+    optimized: {source name: {size, mtime_ns, sha256, settings, outputs}}.
+    An unchanged source is recognised from its stat() alone; the content hash is
+    only read when the size matches but the mtime moved (touched/copied files).
+    """
+
+    def __init__(self, out_dir: Path):
+        self.out_dir = out_dir
+        self.path = out_dir / MANIFEST_NAME
+        self.entries = {}
+        self.dirty = False
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("version") == MANIFEST_VERSION:
+                self.entries = data.get("entries", {})
+        except (OSError, ValueError):
+            pass
+
+    def is_up_to_date(self, src: Path, st: os.stat_result, settings: str) -> bool:
+        e = self.entries.get(src.name)
+        if not e or e["settings"] != settings or e["size"] != st.st_size:
+            return False
+        if not all((self.out_dir / name).exists() for name in e["outputs"]):
+            return False
+        if e["mtime_ns"] == st.st_mtime_ns:
+            return True
+        if file_sha256(src) == e["sha256"]:
+            e["mtime_ns"] = st.st_mtime_ns
+            self.dirty = True
+            return True
+        return False
+
+    def forget(self, src: Path):
+        """Drops a deleted source and returns the output names that were made from it."""
+        e = self.entries.pop(src.name, None)
+        if e is None:
+            return []
+        self.dirty = True
+        return e["outputs"]
+
+    def record(self, src: Path, size: int, mtime_ns: int, sha256: str, outputs, settings: str):
+        self.entries[src.name] = {"size": size, "mtime_ns": mtime_ns, "sha256": sha256,
+                                  "settings": settings, "outputs": list(outputs)}
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty or not self.out_dir.exists():
+            return
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "entries": self.entries}, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+class Manifests:
+    """Lazily opened Manifest per optimized/ folder."""
+
+    def __init__(self):
+        self.by_dir = {}
+
+    def for_source(self, src: Path) -> Manifest:
+        out_dir = src.parent / OUTPUT_DIR
+        if out_dir not in self.by_dir:
+            self.by_dir[out_dir] = Manifest(out_dir)
+        return self.by_dir[out_dir]
+
+    def is_unchanged(self, src: Path, settings: str) -> bool:
+        try:
+            return self.for_source(src).is_up_to_date(src, src.stat(), settings)
+        except OSError:
+            return False  # let the optimizer report it
+
+    def record(self, result: dict, settings: str):
+        if result["ok"] and "sha256" in result:  # files only, not archive members
+            self.for_source(result["src"]).record(result["src"], result["in_bytes"], result["mtime_ns"],
+                                                  result["sha256"], result["outputs"], settings)
+
+    def remove_outputs(self, src: Path) -> int:
+        """Deletes the outputs recorded for a source that no longer exists; returns how many were removed."""
+        manifest = self.for_source(src)
+        removed = 0
+        for name in manifest.forget(src):
+            try:
+                (manifest.out_dir / name).unlink()
+                removed += 1
+            except FileNotFoundError:
+                pass  # the whole folder was moved or deleted
+        return removed
+
+    def save(self):
+        for m in self.by_dir.values():
+            m.save()
+
+def write_srcset_manifests(results, removed=()):
+    """
+    Merges renditions into <optimized>/srcset.json:
+    {source name: [{file, format, width, height, bytes}, ...]}
+    Sources in removed (deleted originals) are dropped from it.
+    """
+    by_dir = {}
+    for r in results:
+        if r["ok"]:
+            by_dir.setdefault(output_dir(r["src"]), []).append(r)
+    for src in removed:
+        by_dir.setdefault(src.parent / OUTPUT_DIR, [])
+    for out_dir, rs in by_dir.items():
+        path = out_dir / SRCSET_MANIFEST
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            if not rs:
+                continue
+            data = {}
+        for r in rs:
+            data[r["src"].name] = sorted(r["renditions"], key=lambda o: (o["format"], o["width"]))
+        for src in removed:
+            if src.parent / OUTPUT_DIR == out_dir:
+                data.pop(src.name, None)
+        tmp = path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp, path)
+
+# ---------- Streaming API ----------
+def optimize_stream(files, config: OptimizerConfig = OptimizerConfig(), executor="serial", jobs: int = 1,
+                    incremental: bool = True, force: bool = False, cancel=None, max_in_flight: int = None,
+                    archive_out=None):
+    """
+    Yields one result record per file as files finish (completion order, not input order).
+    - executor: "serial", "thread", "process" or an existing concurrent.futures.Executor
+    - incremental: files the manifest says are unchanged are yielded right away with
+      "skipped": True; finished files are recorded (force re-optimizes but still records)
+    - cancel: a threading.Event; stops submitting, drops queued files and lets the ones
+      already running finish
+    - archive_out: write every output into this .zip/.tar(.gz) instead of optimized/
+      folders; workers return the encoded bytes and each result is written as it
+      finishes (incremental skipping is off, the archive is rebuilt every run and only
+      appears once the run completes; a cancelled or interrupted run leaves no archive)
+    At most max_in_flight (default jobs * 4) files are submitted at a time, so `files`
+    can be a lazy iterator and memory stays flat on huge folders. This is also the
+    read-ahead bound for archive members and for outputs waiting to be written.
+    """
+    writer = ArchiveWriter(archive_out) if archive_out else None
+    own = isinstance(executor, str)
+    ex = make_executor(executor, jobs) if own else executor
+    limit = max_in_flight or max(1, jobs) * 4
+    manifests = Manifests() if incremental and writer is None else None
+    settings = config.signature()
+    srcset = []
+    pending = set()
+    complete = False
+
+    def finish(done):
+        for fut in done:
+            result = fut.result()
+            if writer is not None:
+                writer.add_result(result)
+            if manifests is not None:
+                manifests.record(result, settings)
+            if config.renditions and result["ok"]:
+                srcset.append(result)
+            yield result
+
+    try:
+        for src in files:
+            if cancel is not None and cancel.is_set():
+                break
+            if (manifests is not None and not force and not isinstance(src, ArchiveMember)
+                    and manifests.is_unchanged(src, settings)):
+                result = new_result(src)
+                result["skipped"] = True
+                yield result
+                continue
+            pending.add(ex.submit(optimize_image, src, config, writer is not None))
+            if len(pending) >= limit:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                yield from finish(done)
+        if cancel is not None and cancel.is_set():
+            pending = {fut for fut in pending if not fut.cancel()}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            yield from finish(done)
+        complete = cancel is None or not cancel.is_set()
+    finally:
+        if own:
+            ex.shutdown(wait=True, cancel_futures=True)
+        if manifests is not None:
+            manifests.save()  # keep progress even if the run is interrupted
+        if writer is not None:
+            if srcset and complete:
+                writer.write_srcset(srcset)
+            writer.close(complete)
+        elif srcset:
+            write_srcset_manifests(srcset)
+
+# ---------- Stage report ----------
+def percentile(values, pct: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, round(pct / 100 * (len(values) - 1)))]
+
+def build_report(results, elapsed: float) -> dict:
+    """Per-stage percentiles, slowest files and bytes saved for one run (skipped files excluded)."""
+    results = [r for r in results if not r["skipped"]]
+    timed = [r for r in results if r["timings"]]
+    names = [n for n in STAGE_ORDER if any(n in r["timings"] for r in timed)]
+    names += sorted({n for r in timed for n in r["timings"]} - set(names))
+    grand_total = sum(sum(r["timings"].values()) for r in timed) or 1.0
+    stages = {}
+    for name in names:
+        values = [r["timings"][name] for r in timed if name in r["timings"]]
+        stages[name] = {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 2),
+            "p90_ms": round(percentile(values, 90) * 1000, 2),
+            "p99_ms": round(percentile(values, 99) * 1000, 2),
+            "max_ms": round(max(values) * 1000, 2),
+            "total_s": round(sum(values), 3),
+            "share": round(sum(values) / grand_total, 3),
+        }
+    slowest = sorted(timed, key=lambda r: sum(r["timings"].values()), reverse=True)[:SLOWEST_FILES]
+    ok = [r for r in results if r["ok"]]
+    in_bytes = sum(r["in_bytes"] for r in ok)
+    out_bytes = sum(sum(r["out_bytes"].values()) for r in ok)
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "images": len(results),
+        "optimized": len(ok),
+        "over_budget": sum(1 for r in ok if r["over_budget"]),
+        "elapsed_s": round(elapsed, 3),
+        "megapixels": round(sum(r["megapixels"] for r in timed), 2),
+        "stages": stages,
+        "slowest": [{"file": str(r["src"]), "total_ms": round(sum(r["timings"].values()) * 1000, 1),
+                     "megapixels": r["megapixels"],
+                     "stages_ms": {k: round(v * 1000, 1) for k, v in r["timings"].items()}} for r in slowest],
+        "bytes": {"in": in_bytes, "out": out_bytes, "saved": in_bytes - out_bytes,
+                  "by_format": {fmt: sum(r["out_bytes"].get(fmt, 0) for r in ok) for fmt in ("jpg", "webp")}},
+    }
+
+def print_report(report: dict):
+    print(f"\n{'stage':<16}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}{'max ms':>10}{'total s':>10}{'share':>8}")
+    for name, st in report["stages"].items():
+        print(f"{name:<16}{st['p50_ms']:>10.1f}{st['p90_ms']:>10.1f}{st['p99_ms']:>10.1f}"
+              f"{st['max_ms']:>10.1f}{st['total_s']:>10.2f}{st['share'] * 100:>7.1f}%")
+    if report["slowest"]:
+        print("\nSlowest files:")
+        for r in report["slowest"]:
+            worst = max(r["stages_ms"], key=r["stages_ms"].get)
+            print(f"  {r['total_ms']:>9.1f} ms  {r['megapixels']:>6.1f} MP  (mostly {worst})  {r['file']}")
+    b = report["bytes"]
+    print(f"\n{format_bytes(b['in'])} in -> {format_bytes(b['out'])} out, saved {format_bytes(b['saved'])}")
+
+def write_report(report: dict, path):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+# ---------- Near-duplicate detection ----------
+def dhash(path):
+    """
+    Returns (hash, pixels, bytes) for one file or archive member, or None if it can't be decoded.
+    JPEGs are draft-decoded (luma only, up to 1/8 scale) since only a tiny thumbnail is needed.
+    """
+    try:
+        img = Image.open(open_source(path))
+        pixels = img.width * img.height
+        if img.format == 'JPEG':
+            img.draft('L', (HASH_SIZE * 4, HASH_SIZE * 4))
+        img = ImageOps.exif_transpose(img)
+        small = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    except Exception:
+        return None
+    px = small.tobytes()
+    h = 0
+    for row in range(HASH_SIZE):
+        for col in range(HASH_SIZE):
+            i = row * (HASH_SIZE + 1) + col
+            h = (h << 1) | (px[i] > px[i + 1])
+    return h, pixels, source_size(path)
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+class BKTree:
+    """Metric tree over Hamming distance: finds all hashes within a radius without comparing every pair."""
+
+    def __init__(self):
+        self.root = None  # [hash, items, {distance: child}]
+
+    def add(self, h: int, item):
+        if self.root is None:
+            self.root = [h, [item], {}]
+            return
+        node = self.root
+        while True:
+            d = hamming(h, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            if d not in node[2]:
+                node[2][d] = [h, [item], {}]
+                return
+            node = node[2][d]
+
+    def query(self, h: int, radius: int):
+        """Yields (item, distance) for every stored hash within radius of h."""
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            d = hamming(h, node[0])
+            if d <= radius:
+                for item in node[1]:
+                    yield item, d
+            for dist, child in node[2].items():
+                if d - radius <= dist <= d + radius:
+                    stack.append(child)
+
+def find_duplicates(files, executor="serial", jobs: int = 1, max_distance: int = DUP_DISTANCE,
+                    window: int = None):
+    """
+    Hashes every file (on the given executor) and groups near-duplicates.
+    Returns (files to optimize, groups); each group keeps its largest-resolution
+    (then largest file) copy: {"keep": path, "duplicates": [{"path", "distance"}]}.
+    Files are hashed `window` at a time (default jobs * 8), which bounds the archive
+    member bytes held in memory; members are kept without their bytes, so pass the
+    kept files through reread_members() before optimizing them.
+    """
+    size = window or max(1, jobs) * 8
+
+    def hash_windows(ex):
+        it = iter(files)
+        while True:
+            batch = list(itertools.islice(it, size))
+            if not batch:
+                return
+            for src, h in zip(batch, ex.map(dhash, batch, chunksize=4)):
+                yield source_ref(src), h
+
+    if isinstance(executor, str):
+        with make_executor(executor, jobs) as ex:
+            pairs = list(hash_windows(ex))
+    else:
+        pairs = list(hash_windows(executor))
+    files = [src for src, _ in pairs]
+    hashes = [h for _, h in pairs]
+
+    tree = BKTree()
+    parent = list(range(len(files)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, h in enumerate(hashes):
+        if h is None:
+            continue
+        for j, _ in tree.query(h[0], max_distance):
+            parent[find(i)] = find(j)
+        tree.add(h[0], i)
+
+    members = {}
+    for i, h in enumerate(hashes):
+        members.setdefault(find(i) if h else i, []).append(i)
+
+    keep, groups = [], []
+    for idx in members.values():
+        best = max(idx, key=lambda i: (hashes[i][1], hashes[i][2]) if hashes[i] else (0, 0))
+        keep.append(files[best])
+        if len(idx) > 1:
+            groups.append({"keep": str(files[best]),
+                           "duplicates": [{"path": str(files[i]), "distance": hamming(hashes[i][0], hashes[best][0])}
+                                          for i in idx if i != best]})
+    return sorted(keep, key=str), groups
+
+def write_duplicates_report(groups, path, max_distance: int = DUP_DISTANCE):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"max_distance": max_distance, "hash_bits": HASH_SIZE * HASH_SIZE, "groups": groups}, f, indent=2)
+
+# ---------- File discovery ----------
+def iter_image_entries(root):
+    """
+    Depth-first os.scandir walk yielding the DirEntry of every supported image below root.
+    File types come from the entries' cached directory data (no stat per file), the
+    extension check is a frozenset lookup, and optimized/ folders are never entered.
+    """
+    stack = [os.fspath(root)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue  # unreadable or vanished folder
+        subdirs = []
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name != OUTPUT_DIR:
+                            subdirs.append(entry.path)
+                    elif is_image_name(entry.name) and entry.is_file():
+                        yield entry
+                except OSError:
+                    continue
+        stack.extend(reversed(subdirs))
+
+def gather_files(inputs, sort: bool = False):
+    """
+    Yields image paths from files and folders as they are found, so the workers can
+    start long before a big tree has been listed. Overlapping inputs yield each file once.
+    A .zip/.tar(.gz) input yields its images as ArchiveMembers (see iter_archive);
+    archives found inside folders are left alone.
+    sort=True lists each folder fully first and yields its images in path order
+    (archive members always come in archive order).
+    """
+    seen = set()
+    for item in inputs:
+        p = Path(item)
+        if p.is_dir():
+            paths = (Path(entry.path) for entry in iter_image_entries(p))
+            if sort:
+                paths = sorted(paths)
+        elif p.is_file() and archive_kind(p):
+            key = os.path.normcase(os.path.abspath(p))
+            if key not in seen:
+                seen.add(key)
+                yield from iter_archive(p)
+            continue
+        elif p.is_file() and is_image_file(p):
+            paths = (p,)
+        else:
+            continue
+        for path in paths:
+            key = os.path.normcase(os.path.abspath(path))
+            if key not in seen:
+                seen.add(key)
+                yield path
@@ -0,0 +1,233 @@
+"""
+pdf_qa_benchmark.py
+Benchmark harness for pdf_qa_offline.py:
+- Generates a synthetic corpus (real PDFs, or page texts only) of configurable size
+- Times each stage: extraction, chunking, encoding, dense and lexical (BM25)
+  index build, single queries and one batched query run; queries go through
+  qa.search() with the configured retrieval mode (hybrid by default)
+- Writes the results to JSON (with the git commit) so runs can be compared
+- Runs fully offline: a deterministic hashing encoder (default, for CI)
+  or the locally cached sentence-transformers model
+Usage:
+    python pdf_qa_benchmark.py --pages 200 --out bench.json
+    python pdf_qa_benchmark.py --text-only --pages 5000 --compare bench.json
+"""
+
+import os
+import json
+import time
+import random
+import hashlib
+import argparse
+import platform
+import subprocess
+import tempfile
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+import pdf_qa_offline as qa
+
+# ---------- Config ----------
+WORDS = ("pump valve pressure sensor calibrate manual reset filter motor voltage "
+         "current flow inlet outlet seal gasket bearing shaft housing torque "
+         "alarm warning fault check replace inspect clean tighten loosen "
+         "the a of to and in for with on is are be this that when after before").split()
+LINES_PER_PAGE = 45
+WORDS_PER_LINE = 12
+N_QUERIES = 200
+FAKE_DIM = 384            # same width as all-MiniLM-L6-v2
+
+# ---------- Synthetic corpus ----------
+def synthetic_pages(n_pages: int, seed: int = 0) -> List[str]:
+    """Deterministic page texts: sentences, paragraph breaks and part/error codes."""
+    rng = random.Random(seed)
+    pages = []
+    for _ in range(n_pages):
+        lines = []
+        for _ in range(LINES_PER_PAGE):
+            words = [rng.choice(WORDS) for _ in range(WORDS_PER_LINE)]
+            if rng.random() < 0.2:
+                words[rng.randrange(WORDS_PER_LINE)] = f"E-{rng.randrange(1000, 9999)}"
+            line = " ".join(words)
+            lines.append(line[0].upper() + line[1:] + ".")
+            if rng.random() < 0.1:
+                lines.append("")
+        pages.append("\n".join(lines))
+    return pages
+
+def _pdf_escape(s: str) -> str:
+    return s.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+def write_pdf(path: Path, pages: List[str]):
+    """Minimal single-font PDF writer, enough for pdfplumber to extract the lines back."""
+    objects = [None, None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_refs = []
+    for text in pages:
+        ops = ["BT /F1 9 Tf 11 TL 36 806 Td"]
+        for line in text.split("\n"):
+            ops.append(f"({_pdf_escape(line)}) Tj T*")
+        ops.append("ET")
+        stream = "\n".join(ops).encode("latin-1", "replace")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_ref = len(objects)
+        objects.append(("<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                        f"/Resources << /Font << /F1 3 0 R >> >> /Contents {content_ref} 0 R >>").encode())
+        page_refs.append(len(objects))
+    objects[0] = b"<< /Type /Catalog /Pages 2 0 R >>"
+    kids = " ".join(f"{r} 0 R" for r in page_refs)
+    objects[1] = f"<< /Type /Pages /Kids [{kids}] /Count {len(page_refs)} >>".encode()
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for n, obj in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % n + obj + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for off in offsets:
+        out += b"%010d 00000 n \n" % off
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    path.write_bytes(bytes(out))
+
+def synthetic_queries(n: int, seed: int = 1) -> List[str]:
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(n):
+        words = [rng.choice(WORDS) for _ in range(rng.randint(3, 8))]
+        if rng.random() < 0.3:
+            words.append(f"E-{rng.randrange(1000, 9999)}")
+        queries.append(" ".join(words))
+    return queries
+
+# ---------- Encoders ----------
+class HashingEncoder:
+    """
+    Deterministic stand-in for SentenceTransformer (feature hashing of words).
+    Same encode() signature as used by pdf_qa_offline, no model download needed.
+    """
+
+    def __init__(self, dim: int = FAKE_DIM):
+        self.dim = dim
+
+    def encode(self, texts, batch_size=32, show_progress_bar=False, convert_to_numpy=True,
+               normalize_embeddings=True, **kwargs):
+        out = np.zeros((len(texts), self.dim), dtype="float32")
+        for row, text in enumerate(texts):
+            for tok in qa.tokenize(text):
+                h = int.from_bytes(hashlib.blake2b(tok.encode(), digest_size=8).digest(), "little")
+                out[row, h % self.dim] += 1.0 if (h >> 63) else -1.0
+        if normalize_embeddings:
+            norms = np.linalg.norm(out, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            out /= norms
+        return out
+
+def make_encoder(kind: str):
+    if kind == "fake":
+        return HashingEncoder()
+    os.environ.setdefault("HF_HUB_OFFLINE", "1")  # only use the locally cached model
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(qa.EMBED_MODEL_NAME)
+
+# ---------- Benchmark ----------
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+def run_benchmark(n_pages: int, text_only: bool, encoder: str, workers: int = 1,
+                  n_queries: int = N_QUERIES, retrieval: str = None) -> dict:
+    qa.RETRIEVAL = retrieval or qa.RETRIEVAL
+    stages = {}
+
+    def stage(name, fn):
+        t0 = time.perf_counter()
+        result = fn()
+        stages[name] = round(time.perf_counter() - t0, 4)
+        print(f"  {name:<14}{stages[name]:>9.3f}s")
+        return result
+
+    # import the lazily loaded libraries up front so later stages time only their own work
+    stage("import", lambda: (qa.faiss.IndexFlatIP, qa.pdfplumber.open))
+    pages = synthetic_pages(n_pages)
+    with tempfile.TemporaryDirectory() as tmp:
+        if text_only:
+            print(f"Corpus: {n_pages} synthetic pages (text only)")
+        else:
+            pdf_path = Path(tmp) / "synthetic.pdf"
+            write_pdf(pdf_path, pages)
+            print(f"Corpus: {n_pages} synthetic pages, {pdf_path.stat().st_size / 1e6:.1f} MB PDF")
+            pages = stage("extract", lambda: qa.extract_pages(pdf_path, workers))
+
+    chunks = stage("chunk", lambda: list(qa.iter_chunks(pages)))
+    model = stage("load_encoder", lambda: make_encoder(encoder))
+    texts = [c.text for c in chunks]
+    embeddings = stage("encode", lambda: qa.build_embeddings(model, texts))
+    index = stage("index_build", lambda: qa.create_faiss_index(embeddings))
+    bm25 = stage("bm25_build", lambda: qa.BM25Index.build(texts)) if qa.RETRIEVAL != "dense" else None
+
+    queries = synthetic_queries(n_queries)
+
+    def single():
+        for q in queries:
+            qa.search(index, bm25, [q], qa.encode_queries(model, [q]), qa.TOP_K)
+
+    def batched():
+        qa.search(index, bm25, queries, qa.encode_queries(model, queries), qa.TOP_K)
+
+    stage("query_single", single)
+    stage("query_batch", batched)
+
+    return {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {
+            "pages": n_pages, "text_only": text_only, "encoder": encoder, "workers": workers,
+            "chunk_size": qa.CHUNK_SIZE, "chunk_overlap": qa.CHUNK_OVERLAP,
+            "index_type": qa.INDEX_TYPE, "retrieval": qa.RETRIEVAL, "queries": n_queries,
+        },
+        "counts": {"chunks": len(chunks), "dim": int(embeddings.shape[1])},
+        "stages": stages,
+        "rates": {
+            "chunks_per_sec_encode": round(len(chunks) / stages["encode"], 1) if stages["encode"] else None,
+            "ms_per_query_single": round(stages["query_single"] / n_queries * 1000, 3),
+            "ms_per_query_batch": round(stages["query_batch"] / n_queries * 1000, 3),
+        },
+    }
+
+def compare(result: dict, baseline_file: Path):
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    if base.get("config") != result["config"]:
+        print("Note: baseline was run with a different config.")
+    print(f"\nvs {baseline_file} (commit {base.get('commit')}):")
+    for name, sec in result["stages"].items():
+        old = base.get("stages", {}).get(name)
+        if old:
+            print(f"  {name:<14}{old:>9.3f}s -> {sec:>9.3f}s  ({(sec - old) / old * 100:+.1f}%)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pdf_qa_offline pipeline on synthetic data.")
+    parser.add_argument("--pages", type=int, default=100, help="synthetic corpus size in pages")
+    parser.add_argument("--text-only", action="store_true", help="skip PDF generation/extraction")
+    parser.add_argument("--encoder", choices=["fake", "model"], default="fake",
+                        help="fake = deterministic hashing encoder (CI), model = locally cached model")
+    parser.add_argument("--workers", type=int, default=1, help="processes for page extraction")
+    parser.add_argument("--queries", type=int, default=N_QUERIES)
+    parser.add_argument("--retrieval", choices=["dense", "lexical", "hybrid"], default=qa.RETRIEVAL,
+                        help="retrieval mode the queries run through (default %(default)s)")
+    parser.add_argument("--out", default="pdf_qa_bench.json", help="where to write the JSON results")
+    parser.add_argument("--compare", help="previous results JSON to diff against")
+    args = parser.parse_args()
+
+    result = run_benchmark(args.pages, args.text_only, args.encoder, args.workers, args.queries, args.retrieval)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(result, f, indent=2)
+    print(f"Results written to {args.out}")
+    if args.compare:
+        compare(result, Path(args.compare))
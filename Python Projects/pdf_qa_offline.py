@@ -2,99 +2,1369 @@
 pdf_qa_offline.py
 Offline PDF Q&A:
 - Extracts text from PDF
-- Chunks text (overlap)
+- Chunks text on paragraph/sentence boundaries with overlap, streaming page by page
 - Builds embeddings with sentence-transformers locally
 - Uses FAISS for nearest-neighbor retrieval
 - Interactive CLI: ask questions -> shows top-k matching passages
+- Caches chunks, embeddings and the index on disk, keyed by PDF content hash
+- Corpus mode: pass a folder to search all its PDFs through one shared index,
+  updated incrementally (only new/changed PDFs are embedded, deleted ones removed)
+- Index types: exact flat, or approximate IVF-Flat / IVF-PQ / HNSW, with a
+  recall/latency/memory benchmark (--bench-index)
+- Batch mode: --questions file.txt|.jsonl answers all questions at once -> JSONL
+- Hybrid retrieval: BM25 over an in-memory inverted index fused with the dense
+  results (reciprocal rank fusion), so exact part numbers / error codes still match
+- Low-RAM mode: --store float16|int8 keeps quantized embeddings in a memory-mapped
+  .npy searched in blocks (no second copy in a FAISS index), in corpus mode too;
+  --index sq8|sqfp16 uses FAISS scalar quantization instead
+- Serve mode: --serve PORT exposes /search, bulk POST /search and /metrics over
+  local HTTP; one model/index shared by all users, concurrent queries micro-batched
+- Fast startup: heavy libraries are imported on first use, the model loads on a
+  background thread while the PDF is extracted/chunked, and a timing breakdown
+  is printed before the prompt
+- --encode-workers N shards chunk encoding across N processes; --mmr re-ranks the
+  top hits with maximal marginal relevance so overlapping chunks don't crowd out
+  other passages
+- Repeated questions are answered from a bounded LRU cache (query embedding +
+  top-k), optionally persisted per index and invalidated when the index changes
 No external API required.
 """
 
-import sys
+import os
+import re
+import json
+import time
+import bisect
+import shutil
+import hashlib
+import itertools
+import argparse
+from collections import OrderedDict, deque
+import threading
+import queue
+import atexit
+import importlib
+import multiprocessing
+from array import array
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
 from pathlib import Path
-from typing import List, Tuple
+from typing import Iterable, Iterator, List, NamedTuple, Optional
 import math
-import pdfplumber
 import numpy as np
-from sentence_transformers import SentenceTransformer
-import faiss
-from tqdm import tqdm
 
 # ---------- Config ----------
 EMBED_MODEL_NAME = "all-MiniLM-L6-v2"  # compact and fast
 CHUNK_SIZE = 800          # characters per chunk
 CHUNK_OVERLAP = 150       # overlap between chunks
+CHUNKER_VERSION = 2       # bump when chunk boundaries change, invalidates caches
+EMBED_BATCH = 256         # chunks per encoder call while streaming a PDF (x workers when sharded)
+ENCODE_WORKERS = 1        # >1: encode chunks in that many processes (encode_multi_process)
 TOP_K = 5                 # how many passages to return for each query
+INDEX_TYPE = "flat"       # flat (exact) | ivf | ivfpq | hnsw | sq8 | sqfp16
+NPROBE = 16               # IVF lists visited per query (higher = better recall, slower)
+EF_SEARCH = 64            # HNSW candidate list size per query
+HNSW_M = 32               # HNSW graph degree
+TRAIN_SAMPLE = 100_000    # max vectors used to train IVF/PQ/SQ
+CORPUS_TRAIN_MIN = 10_000 # corpus ivf/ivfpq: chunks before the shared index is trained (flat until then)
+CORPUS_RETRAIN_GROWTH = 4 # corpus ivf: retrain once the index has grown this much since the last training
+EMBED_STORE = "float32"   # float32 (FAISS index in RAM) | float16 | int8 (memory-mapped scan)
+SCAN_BLOCK = 65536        # rows per block when scanning a memory-mapped store
+RETRIEVAL = "hybrid"      # dense | lexical | hybrid (BM25 + dense, reciprocal rank fusion)
+BM25_K1 = 1.2
+BM25_B = 0.75
+TOKENIZER_VERSION = 2     # bump when tokenize() changes, invalidates saved lexical indexes
+RRF_K = 60                # rank-fusion constant: larger = flatter weighting of ranks
+FUSION_CANDIDATES = 50    # hits taken from each retriever before fusing
+MMR = False               # re-rank results with maximal marginal relevance
+MMR_LAMBDA = 0.7          # 1.0 = pure relevance, lower = more diverse
+MMR_CANDIDATES = 20       # hits considered by the MMR re-rank
+QUERY_CACHE_SIZE = 1024   # repeated-question LRU entries (0 disables)
+PERSIST_QUERY_CACHE = False  # keep the LRU between sessions (stored next to the index)
+QUERY_BATCH = 256         # questions encoded + searched per batch in --questions mode
+SERVE_HOST = "127.0.0.1"
+SERVE_PORT = None         # set by --serve: run the HTTP service instead of the prompt
+BATCH_WINDOW_MS = 5       # how long the batcher waits for more queries to join a batch
+MAX_K = 100               # largest k a /search request may ask for (a batch is searched with its largest k)
+REQUEST_TIMEOUT = 120     # seconds a /search request waits for its batch (covers the first model load)
+CACHE_DIR = Path.home() / ".cache" / "pdf_qa_offline"  # chunks/embeddings/index per PDF
+
+# ---------- Lazy imports & timing ----------
+TIMINGS = {}  # stage -> seconds, in the order stages first ran
+_timings_lock = threading.Lock()
+
+def add_timing(stage: str, seconds: float):
+    with _timings_lock:
+        TIMINGS[stage] = TIMINGS.get(stage, 0.0) + seconds
+
+_timer_frames = threading.local()
+
+@contextmanager
+def timed(stage: str):
+    # exclusive timing: time spent in a nested timed() is charged to the inner stage only
+    frames = _timer_frames.__dict__.setdefault("stack", [])
+    frame = [0.0]
+    frames.append(frame)
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        frames.pop()
+        add_timing(stage, elapsed - frame[0])
+        if frames:
+            frames[-1][0] += elapsed
+
+def print_timings():
+    with _timings_lock:
+        items = list(TIMINGS.items())
+    if not items:
+        return
+    print("\nStartup timing:")
+    for stage, sec in items:
+        note = "  (background, overlaps the stages above)" if stage == "load model" else ""
+        print(f"  {stage:<12}{sec:>8.2f}s{note}")
+
+class _LazyModule:
+    """Imports the real module on first attribute access and records the import time."""
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with timed("import"):
+                self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+pdfplumber = _LazyModule("pdfplumber")
+faiss = _LazyModule("faiss")
+
+# the model is loaded once, normally on a background thread started at startup
+_model = None
+_model_error = None
+_model_thread = None
+
+def _load_model_now():
+    global _model, _model_error
+    try:
+        with timed("import"):
+            from sentence_transformers import SentenceTransformer
+        with timed("load model"):
+            _model = SentenceTransformer(EMBED_MODEL_NAME)
+    except Exception as e:
+        _model_error = e
+
+def start_model_loading():
+    global _model_thread
+    if _model is None and _model_thread is None:
+        _model_thread = threading.Thread(target=_load_model_now, daemon=True)
+        _model_thread.start()
+
+def load_model():
+    if _model is None:
+        if _model_thread is None:
+            print("Loading embedding model (this may take a moment)...")
+            _load_model_now()
+        elif _model_thread.is_alive():
+            print("Waiting for embedding model to finish loading...")
+            with timed("wait model"):
+                _model_thread.join()
+    if _model_error is not None:
+        raise _model_error
+    return _model
 
 # ---------- Helpers ----------
-def extract_text_from_pdf(pdf_path: Path) -> str:
-    text_parts = []
+class Chunk(NamedTuple):
+    text: str     # stripped chunk text
+    start: int    # char offsets into the pages joined with "\n\n" (empty pages skipped)
+    end: int
+    page: int     # 1-based page the chunk starts on
+
+def _extract_page_range(args) -> List[str]:
+    # runs in a worker process: each worker needs its own pdfplumber handle
+    pdf_path, start, end = args
+    texts = []
     with pdfplumber.open(pdf_path) as pdf:
-        for page in pdf.pages:
-            txt = page.extract_text()
-            if txt:
-                text_parts.append(txt)
-    return "\n\n".join(text_parts)
-
-def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[Tuple[str,int,int]]:
-    """
-    Returns list of tuples: (chunk_text, start_char, end_char)
-    """
-    chunks = []
-    start = 0
-    text_len = len(text)
-    while start < text_len:
-        end = min(start + chunk_size, text_len)
-        chunk = text[start:end]
-        # If possible, extend to nearest sentence end for readability
-        # but keep simple to avoid heavy NLP.
-        chunks.append((chunk.strip(), start, end))
-        if end == text_len:
-            break
-        start = max(end - overlap, end) - (0)  # ensure progress
-    return chunks
+        for page in pdf.pages[start:end]:
+            texts.append(page.extract_text() or "")
+            page.flush_cache()
+    return texts
+
+def iter_pages(pdf_path: Path, workers: int = 1) -> Iterator[str]:
+    """
+    Yields the text of every page, in page order (empty string for pages without text).
+    With workers > 1 the page range is split across a process pool; pages are yielded
+    as soon as their range is done, so the consumer can work while later ranges extract.
+    """
+    t0 = time.perf_counter()
+    with pdfplumber.open(pdf_path) as pdf:
+        n_pages = len(pdf.pages)
+        workers = max(1, min(workers, n_pages))
+        if workers == 1:
+            for page in pdf.pages:
+                yield page.extract_text() or ""
+                page.flush_cache()
+    if workers > 1:
+        # a few ranges per worker keeps the pool busy when some pages are much heavier
+        n_ranges = min(n_pages, workers * 4)
+        step = math.ceil(n_pages / n_ranges)
+        ranges = [(pdf_path, s, min(s + step, n_pages)) for s in range(0, n_pages, step)]
+        # spawn, not fork: the model may be loading on another thread right now
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as ex:
+            for texts in ex.map(_extract_page_range, ranges):  # map keeps range order
+                yield from texts
+    elapsed = time.perf_counter() - t0
+    rate = n_pages / elapsed if elapsed > 0 else float("inf")
+    print(f"Extracted {n_pages} pages in {elapsed:.2f}s ({rate:.1f} pages/sec, {workers} worker(s)).")
+
+def extract_pages(pdf_path: Path, workers: int = 1) -> List[str]:
+    return list(iter_pages(pdf_path, workers))
+
+def page_for_offset(offset: int, page_starts: List[int], page_numbers: List[int]) -> int:
+    if not page_starts:
+        return 0
+    i = bisect.bisect_right(page_starts, offset) - 1
+    return page_numbers[max(i, 0)]
+
+SENTENCE_END_RE = re.compile(r"[.!?][\"')\]]*\s")
+
+def _cut_point(buf: str, lo: int, hi: int) -> int:
+    """Where to end a chunk inside buf[lo:hi]: paragraph break, else sentence end, else word."""
+    window = buf[lo:hi]
+    i = window.rfind("\n\n")
+    if i >= 0:
+        return lo + i + 2
+    last = None
+    for last in SENTENCE_END_RE.finditer(window):
+        pass
+    if last is not None:
+        return lo + last.end()
+    i = max(window.rfind(" "), window.rfind("\n"))
+    if i >= 0:
+        return lo + i + 1
+    return hi
+
+def iter_chunks(pages: Iterable[str], chunk_size: int = CHUNK_SIZE,
+                overlap: int = CHUNK_OVERLAP) -> Iterator[Chunk]:
+    """
+    Streaming chunker: consumes page texts one at a time and only buffers about one
+    chunk of text. Each chunk ends on a paragraph/sentence/word boundary in its
+    second half, and the next chunk starts about `overlap` chars before that end
+    (moved forward to the next word start).
+    """
+    if not 0 <= overlap < chunk_size - 1:
+        raise ValueError("overlap must be smaller than chunk_size")
+    lo = max(chunk_size // 2, overlap + 1)  # cut > overlap guarantees progress
+    buf = ""
+    buf_start = 0       # global offset of buf[0]
+    covered_end = 0     # global end of the last chunk yielded
+    page_starts, page_numbers = [], []
+    seen_text = False
+
+    def make(cut):
+        return Chunk(buf[:cut].strip(), buf_start, buf_start + cut,
+                     page_for_offset(buf_start, page_starts, page_numbers))
+
+    for page_no, txt in enumerate(pages, start=1):
+        if not txt:
+            continue
+        if seen_text:
+            buf += "\n\n"
+        seen_text = True
+        page_starts.append(buf_start + len(buf))
+        page_numbers.append(page_no)
+        buf += txt
+
+        while len(buf) >= chunk_size:
+            cut = _cut_point(buf, lo, chunk_size)
+            chunk = make(cut)
+            if chunk.text:
+                yield chunk
+            covered_end = chunk.end
+            nxt = cut - overlap
+            ws = re.search(r"\s", buf[nxt:cut])
+            if ws and nxt > 0 and not buf[nxt - 1].isspace():
+                nxt += ws.end()  # don't start mid-word
+            buf_start += nxt
+            buf = buf[nxt:]
+
+    if buf.strip() and buf_start + len(buf) > covered_end:
+        yield make(len(buf))
+
+def chunk_text(text: str, chunk_size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> List[Chunk]:
+    """
+    Returns list of Chunk(text, start_char, end_char, page) for an already joined text.
+    """
+    return list(iter_chunks([text], chunk_size, overlap))
+
+_encode_pool = None
+
+def get_encode_pool(model):
+    """Process pool for sharded encoding, started once and stopped at exit."""
+    global _encode_pool
+    if _encode_pool is None and ENCODE_WORKERS > 1:
+        print(f"Starting {ENCODE_WORKERS} encoder processes...")
+        _encode_pool = model.start_multi_process_pool(target_devices=["cpu"] * ENCODE_WORKERS)
+        atexit.register(model.stop_multi_process_pool, _encode_pool)
+    return _encode_pool
 
 def build_embeddings(model, chunks: List[str]) -> np.ndarray:
     # sentence-transformers returns numpy arrays
-    embeddings = model.encode(chunks, show_progress_bar=True, convert_to_numpy=True, normalize_embeddings=True)
+    pool = get_encode_pool(model)
+    if pool is not None:
+        # shards are encoded in parallel and returned in input order
+        embeddings = model.encode_multi_process(chunks, pool, normalize_embeddings=True,
+                                                chunk_size=max(1, math.ceil(len(chunks) / ENCODE_WORKERS)))
+    else:
+        embeddings = model.encode(chunks, show_progress_bar=False, convert_to_numpy=True, normalize_embeddings=True)
     return embeddings.astype('float32')
 
-def create_faiss_index(embeddings: np.ndarray):
-    dim = embeddings.shape[1]
+def timed_iter(stage: str, iterable):
+    # time spent producing each item is charged to stage (nested stages excluded)
+    it = iter(iterable)
+    while True:
+        with timed(stage):
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+        yield item
+
+def embed_pdf(pdf_path: Path, workers: int = 1, model=None):
+    """
+    Pipeline: pages are extracted, chunked and embedded in EMBED_BATCH batches as
+    they stream in, so the joined document text is never built.
+    Returns (chunks, embeddings) or ([], None) when the PDF has no text.
+    """
+    chunks, parts, batch = [], [], []
+
+    def flush():
+        nonlocal model
+        model = model or load_model()
+        with timed("embed"):
+            parts.append(build_embeddings(model, batch))
+        print(f"\rEmbedded {len(chunks)} chunks...", end="", flush=True)
+        batch.clear()
+
+    pages = timed_iter("extract", iter_pages(pdf_path, workers))
+    for chunk in timed_iter("chunk", iter_chunks(pages)):
+        chunks.append(chunk)
+        batch.append(chunk.text)
+        if len(batch) >= EMBED_BATCH * ENCODE_WORKERS:
+            flush()
+    if batch:
+        flush()
+    if not chunks:
+        return [], None
+    print()
+    return chunks, np.vstack(parts)
+
+def _pq_subquantizers(dim: int) -> int:
+    # PQ needs dim % m == 0; aim for ~8 dims per sub-quantizer
+    for m in range(max(1, dim // 8), 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+def new_ivf_index(dim: int, n: int, index_type: str):
+    """Untrained IVF-Flat / IVF-PQ sized for n vectors, or None if n is too few to train it."""
+    # faiss wants ~39 training points per centroid
+    nlist = min(int(4 * math.sqrt(n)), n // 39)
+    nbits = 8 if n >= 256 * 39 else 4
+    if nlist < 1 or (index_type == "ivfpq" and n < (1 << nbits) * 39):
+        return None
+    quantizer = faiss.IndexFlatIP(dim)
+    if index_type == "ivf":
+        return faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+    return faiss.IndexIVFPQ(quantizer, dim, nlist, _pq_subquantizers(dim), nbits, faiss.METRIC_INNER_PRODUCT)
+
+def create_faiss_index(embeddings: np.ndarray, index_type: str = None):
+    """
+    flat  - exact inner product (cosine on normalized vectors)
+    ivf   - inverted lists over k-means cells, exact vectors inside each cell
+    ivfpq - inverted lists with product-quantized vectors (smallest memory)
+    hnsw  - graph index, no training needed
+    sq8 / sqfp16 - exact scan over 8-bit / 16-bit scalar-quantized vectors (4x / 2x smaller)
+    IVF variants are trained on a random sample of at most TRAIN_SAMPLE vectors and
+    fall back to flat when there are too few vectors to train on.
+    """
+    index_type = index_type or INDEX_TYPE
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    n, dim = embeddings.shape
+
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = max(40, 2 * HNSW_M)
+        index.add(embeddings)
+        set_search_params(index)
+        return index
+
+    rng = np.random.default_rng(0)
+    sample = embeddings if n <= TRAIN_SAMPLE else embeddings[rng.choice(n, TRAIN_SAMPLE, replace=False)]
+
+    if index_type in ("sq8", "sqfp16"):
+        qtype = faiss.ScalarQuantizer.QT_8bit if index_type == "sq8" else faiss.ScalarQuantizer.QT_fp16
+        index = faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+        index.train(sample)  # per-dimension value ranges (no-op for fp16)
+        index.add(embeddings)
+        return index
+
+    if index_type in ("ivf", "ivfpq"):
+        index = new_ivf_index(dim, n, index_type)
+        if index is not None:
+            index.train(sample)
+            index.add(embeddings)
+            set_search_params(index)
+            return index
+        print(f"Too few chunks ({n}) to train '{index_type}', using flat index.")
+
     index = faiss.IndexFlatIP(dim)  # cosine via normalized vectors (use inner product)
     index.add(embeddings)
     return index
 
+def set_search_params(index, nprobe: int = None, ef_search: int = None):
+    """Applies query-time knobs; also works on indexes loaded from disk or wrapped in IndexIDMap."""
+    nprobe = nprobe or NPROBE
+    ef_search = ef_search or EF_SEARCH
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    except RuntimeError:
+        pass
+    inner = faiss.downcast_index(index.index) if isinstance(index, faiss.IndexIDMap) else index
+    if hasattr(inner, "hnsw"):
+        inner.hnsw.efSearch = ef_search
+
+def index_memory_bytes(index) -> int:
+    if isinstance(index, MemmapSearcher):
+        return 0  # pages come from the OS file cache and can be dropped at any time
+    return faiss.serialize_index(index).nbytes
+
+# ---------- Memory-mapped chunk tables ----------
+class TextTable:
+    """
+    Strings stored back to back as UTF-8 in <name>.bin, with their boundaries in
+    <name>.offsets.npy; both are memory-mapped, and table[i] decodes only string i,
+    so opening a table costs no RSS however many strings it holds. A sorted table
+    can be searched with bisect.
+    """
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def open(cls, folder: Path, name: str):
+        offsets = np.load(folder / f"{name}.offsets.npy", mmap_mode="r")
+        empty = offsets[-1] == 0  # np.memmap refuses empty files
+        blob = np.empty(0, dtype="uint8") if empty else np.memmap(folder / f"{name}.bin", dtype="uint8", mode="r")
+        return cls(blob, offsets)
+
+    @staticmethod
+    def write(folder: Path, name: str, strings: Iterable[str]):
+        offsets = array("q", [0])
+        with open(folder / f"{name}.bin", "wb") as f:
+            for text in strings:
+                data = text.encode("utf-8")
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+        np.save(folder / f"{name}.offsets.npy", np.frombuffer(offsets, dtype="int64"))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i) -> str:
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+class ChunkStore:
+    """
+    Read-only chunk list of a cache entry: texts in a TextTable ("chunk_texts") and
+    [start, end, page] rows in chunks.npy, all memory-mapped. store[i] builds one Chunk.
+    """
+
+    def __init__(self, texts: TextTable, rows: np.ndarray):
+        self.texts = texts
+        self.rows = rows
+
+    @classmethod
+    def open(cls, entry: Path):
+        return cls(TextTable.open(entry, "chunk_texts"), np.load(entry / "chunks.npy", mmap_mode="r"))
+
+    @staticmethod
+    def write(entry: Path, chunks: List[Chunk]):
+        TextTable.write(entry, "chunk_texts", (c.text for c in chunks))
+        rows = np.array([(c.start, c.end, c.page) for c in chunks], dtype="int64").reshape(-1, 3)
+        np.save(entry / "chunks.npy", rows)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def __getitem__(self, i) -> Chunk:
+        start, end, page = (int(v) for v in self.rows[i])
+        return Chunk(self.texts[i], start, end, page)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+# ---------- Quantized memory-mapped store ----------
+def int8_scale(embeddings: np.ndarray) -> np.ndarray:
+    scale = np.abs(embeddings).max(axis=0) / 127.0
+    # all-zero dimension: use the widest scale a normalized vector can need, so rows
+    # added later (corpus mode widens, never narrows, the scale) still fit
+    scale[scale == 0] = 1.0 / 127.0
+    return scale.astype("float32")
+
+def quantize_embeddings(embeddings: np.ndarray, store: str, scale: np.ndarray = None):
+    """
+    Returns (data, scale). int8 uses symmetric per-dimension scaling, so
+    x ~= data * scale; scale is None for float16. Pass scale to quantize more rows
+    against an existing int8 store (values beyond it are clipped).
+    """
+    embeddings = np.asarray(embeddings, dtype="float32")
+    if store == "float16":
+        return embeddings.astype("float16"), None
+    if scale is None:
+        scale = int8_scale(embeddings)
+    data = np.clip(np.round(embeddings / scale), -127, 127).astype("int8")
+    return data, scale.astype("float32")
+
+class MemmapSearcher:
+    """
+    Exact inner-product search over a quantized (float16/int8) embedding matrix,
+    normally memory-mapped from disk. Rows are scanned SCAN_BLOCK at a time, so RSS
+    stays bounded by one block regardless of corpus size. For int8 the per-dimension
+    scale is folded into the query instead of dequantizing the matrix.
+    Mirrors the parts of the FAISS index API used here: ntotal and search().
+    ids (ascending) gives the chunk id of each row, like an IndexIDMap; without it
+    results are row numbers.
+    """
+
+    def __init__(self, data: np.ndarray, scale: np.ndarray = None, ids: np.ndarray = None):
+        self.data = data
+        self.scale = scale
+        self.ids = ids
+
+    @classmethod
+    def open(cls, entry: Path, ids: np.ndarray = None):
+        data = np.load(entry / "embeddings.npy", mmap_mode="r")
+        scale_file = entry / "scale.npy"
+        return cls(data, np.load(scale_file) if scale_file.exists() else None, ids)
+
+    @property
+    def ntotal(self) -> int:
+        return self.data.shape[0]
+
+    def rows(self, ids) -> np.ndarray:
+        if self.ids is not None:
+            ids = np.searchsorted(self.ids, ids)
+        emb = np.asarray(self.data[ids], dtype="float32")
+        return emb * self.scale if self.scale is not None else emb
+
+    def dequantized(self) -> np.ndarray:
+        emb = np.asarray(self.data, dtype="float32")
+        return emb * self.scale if self.scale is not None else emb
+
+    def search(self, queries: np.ndarray, k: int):
+        queries = np.asarray(queries, dtype="float32")
+        if self.scale is not None:
+            queries = queries * self.scale
+        nq, n = len(queries), self.ntotal
+        best_D = np.empty((nq, 0), dtype="float32")
+        best_I = np.empty((nq, 0), dtype="int64")
+        for start in range(0, n, SCAN_BLOCK):
+            block = np.asarray(self.data[start:start + SCAN_BLOCK], dtype="float32")
+            cand_D = np.hstack([best_D, queries @ block.T])
+            cand_I = np.hstack([best_I, np.broadcast_to(np.arange(start, start + len(block)), (nq, len(block)))])
+            if cand_D.shape[1] > k:
+                keep = np.argpartition(-cand_D, k - 1, axis=1)[:, :k]
+                cand_D = np.take_along_axis(cand_D, keep, axis=1)
+                cand_I = np.take_along_axis(cand_I, keep, axis=1)
+            best_D, best_I = cand_D, cand_I
+        order = np.argsort(-best_D, axis=1)
+        D = np.full((nq, k), -np.inf, dtype="float32")
+        I = np.full((nq, k), -1, dtype="int64")
+        D[:, :best_D.shape[1]] = np.take_along_axis(best_D, order, axis=1)
+        I[:, :best_I.shape[1]] = np.take_along_axis(best_I, order, axis=1)
+        if self.ids is not None:
+            I = np.where(I >= 0, self.ids[np.maximum(I, 0)], -1)
+        return D, I
+
+def benchmark_indexes(embeddings: np.ndarray, k: int = 10, n_queries: int = 1000):
+    """
+    Compares every index type against the exact flat index.
+    Queries are sampled from the corpus itself (with the self-match included in both
+    ground truth and results, so it does not favour any index).
+    Prints recall@k, mean per-query latency, memory and build time per configuration.
+    For the mmap rows "memory" is the size of the file on disk, not resident memory.
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+    n = embeddings.shape[0]
+    k = min(k, n)
+    rng = np.random.default_rng(1)
+    queries = embeddings[rng.choice(n, min(n_queries, n), replace=False)]
+
+    def timed_search(index):
+        t0 = time.perf_counter()
+        _, I = index.search(queries, k)
+        return I, (time.perf_counter() - t0) / len(queries) * 1000
+
+    results = []
+    t0 = time.perf_counter()
+    flat = create_faiss_index(embeddings, "flat")
+    build = time.perf_counter() - t0
+    truth, ms = timed_search(flat)
+    results.append(("flat", "-", 1.0, ms, index_memory_bytes(flat), build))
+
+    # quantization levels: exact scans, so any recall loss is from quantization alone
+    for index_type in ("sqfp16", "sq8"):
+        t0 = time.perf_counter()
+        index = create_faiss_index(embeddings, index_type)
+        build = time.perf_counter() - t0
+        found, ms = timed_search(index)
+        recall = sum(len(set(t) & set(f)) for t, f in zip(truth, found)) / truth.size
+        results.append((index_type, "-", recall, ms, index_memory_bytes(index), build))
+    for store in ("float16", "int8"):
+        t0 = time.perf_counter()
+        searcher = MemmapSearcher(*quantize_embeddings(embeddings, store))
+        build = time.perf_counter() - t0
+        found, ms = timed_search(searcher)
+        recall = sum(len(set(t) & set(f)) for t, f in zip(truth, found)) / truth.size
+        results.append(("mmap", store, recall, ms, searcher.data.nbytes, build))
+
+    sweeps = {
+        "ivf": ("nprobe", [1, 4, 16, 64]),
+        "ivfpq": ("nprobe", [1, 4, 16, 64]),
+        "hnsw": ("efSearch", [16, 32, 64, 128]),
+    }
+    for index_type, (knob, values) in sweeps.items():
+        t0 = time.perf_counter()
+        index = create_faiss_index(embeddings, index_type)
+        build = time.perf_counter() - t0
+        mem = index_memory_bytes(index)
+        for v in values:
+            if knob == "nprobe":
+                set_search_params(index, nprobe=v)
+            else:
+                set_search_params(index, ef_search=v)
+            found, ms = timed_search(index)
+            hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+            recall = hits / truth.size
+            results.append((index_type, f"{knob}={v}", recall, ms, mem, build))
+
+    print(f"\nIndex benchmark: {n} vectors, dim={embeddings.shape[1]}, {len(queries)} queries, k={k}\n")
+    print(f"{'index':<7}{'param':<14}{'recall@'+str(k):>10}{'ms/query':>11}{'memory MB':>11}{'build s':>9}")
+    for name, param, recall, ms, mem, build in results:
+        print(f"{name:<7}{param:<14}{recall:>10.3f}{ms:>11.3f}{mem / 1e6:>11.2f}{build:>9.2f}")
+    return results
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def cache_key(pdf_path: Path) -> str:
+    """
+    Key changes whenever the PDF bytes, the model or the chunking parameters change,
+    so stale entries are never reused. The index type only matters for float32 stores;
+    a quantized store is searched directly and ignores it.
+    """
+    index_type = INDEX_TYPE if EMBED_STORE == "float32" else ""
+    params = f"{file_sha256(pdf_path)}|{EMBED_MODEL_NAME}|{CHUNK_SIZE}|{CHUNK_OVERLAP}|{CHUNKER_VERSION}|{index_type}|{EMBED_STORE}"
+    return hashlib.sha256(params.encode("utf-8")).hexdigest()[:32]
+
+def load_cache(key: str):
+    """
+    Returns (chunks_meta, embeddings, index) or None if there is no complete entry.
+    chunks_meta is a memory-mapped ChunkStore (a list for entries written before it
+    existed). With a quantized EMBED_STORE the index is a MemmapSearcher over the
+    stored embeddings, so nothing proportional to the corpus is read up front.
+    """
+    entry = CACHE_DIR / key
+    meta_file = entry / "chunks.json"
+    emb_file = entry / "embeddings.npy"
+    index_file = entry / "index.faiss"
+    quantized = EMBED_STORE != "float32"
+    if not (meta_file.exists() and emb_file.exists() and (quantized or index_file.exists())):
+        return None
+    try:
+        with open(meta_file, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        chunks_meta = [Chunk(*c) for c in meta["chunks"]] if "chunks" in meta else ChunkStore.open(entry)
+        if quantized:
+            index = MemmapSearcher.open(entry)
+            embeddings = index.data
+        else:
+            embeddings = np.load(emb_file, mmap_mode="r")
+            index = faiss.read_index(str(index_file))
+            set_search_params(index)
+    except Exception as e:
+        print(f"Ignoring unreadable cache entry {key}: {e}")
+        return None
+    if index.ntotal != len(chunks_meta):
+        return None
+    return chunks_meta, embeddings, index
+
+def save_cache(key: str, pdf_path: Path, chunks_meta: List[Chunk],
+               embeddings: np.ndarray, index=None, scale: np.ndarray = None):
+    entry = CACHE_DIR / key
+    entry.mkdir(parents=True, exist_ok=True)
+    meta = {
+        "source": str(pdf_path.resolve()),
+        "model": EMBED_MODEL_NAME,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "index_type": INDEX_TYPE,
+        "embed_store": EMBED_STORE,
+        "n_chunks": len(chunks_meta),
+    }
+    ChunkStore.write(entry, chunks_meta)
+    np.save(entry / "embeddings.npy", embeddings)
+    if scale is not None:
+        np.save(entry / "scale.npy", scale)
+    if index is not None and not isinstance(index, MemmapSearcher):
+        faiss.write_index(index, str(entry / "index.faiss"))
+    # written last: its presence marks the entry as complete
+    with open(entry / "chunks.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+
+# ---------- Lexical (BM25) ----------
+# Han and kana are written without spaces, so their runs are split into bigrams
+CJK = "\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff"
+CJK_RE = re.compile(f"[{CJK}]")
+# letters/digits of any script; keeps part numbers like "AB-102.5" or "0x1F" as single tokens
+TOKEN_RE = re.compile(rf"[{CJK}]+|[^\W_{CJK}]+(?:[-_./][^\W_{CJK}]+)*")
+
+def tokenize(text: str) -> List[str]:
+    # casefold also expands ligatures PDFs are full of ("\ufb01" -> "fi") and folds "ß" to "ss"
+    tokens = TOKEN_RE.findall(text.casefold())
+    if not CJK_RE.search(text):
+        return tokens
+    out = []
+    for tok in tokens:
+        if CJK_RE.match(tok):
+            out.extend(tok[i:i + 2] for i in range(max(1, len(tok) - 1)))
+        else:
+            out.append(tok)
+    return out
+
+class BM25Index:
+    """
+    Inverted index stored as compact arrays (CSR layout):
+      postings_doc[offsets[t]:offsets[t+1]]  rows containing term t (int32)
+      postings_tf [offsets[t]:offsets[t+1]]  term frequency in those rows
+    doc_ids maps a row back to the chunk id used by the dense index, so both
+    retrievers return ids in the same space. terms is sorted and looked up by
+    bisection, so a saved index can be memory-mapped whole (see load()) and a
+    query only reads the postings of its own terms.
+    """
+
+    def __init__(self, terms, offsets, postings_doc, postings_tf, doc_len, doc_ids):
+        self.terms = terms
+        self.offsets = offsets
+        self.postings_doc = postings_doc
+        self.postings_tf = postings_tf
+        self.doc_len = doc_len
+        self.doc_ids = doc_ids
+        self.avgdl = float(doc_len.mean()) if len(doc_len) else 0.0
+
+    @classmethod
+    def build(cls, texts: Iterable[str], ids=None):
+        # postings are collected as flat typed arrays (term id, tf, terms per row) rather
+        # than per-term Python lists, then grouped by term with one stable argsort
+        first_seen = {}
+        term_ids, tfs, row_terms, doc_len = array("i"), array("f"), array("i"), array("f")
+        for text in texts:
+            counts = {}
+            for tok in tokenize(text):
+                counts[tok] = counts.get(tok, 0) + 1
+            doc_len.append(sum(counts.values()))
+            row_terms.append(len(counts))
+            for tok, tf in counts.items():
+                term_ids.append(first_seen.setdefault(tok, len(first_seen)))
+                tfs.append(tf)
+
+        terms = sorted(first_seen)
+        sorted_id = np.empty(len(terms), dtype="int32")
+        sorted_id[[first_seen[t] for t in terms]] = np.arange(len(terms), dtype="int32")
+        del first_seen
+        term = sorted_id[np.frombuffer(term_ids, dtype=np.intc)]
+        del term_ids
+        order = np.argsort(term, kind="stable")  # keeps rows ascending within a term
+        n_rows = len(row_terms)
+        postings_doc = np.repeat(np.arange(n_rows, dtype="int32"), np.frombuffer(row_terms, dtype=np.intc))[order]
+        postings_tf = np.frombuffer(tfs, dtype="float32")[order]
+        offsets = np.zeros(len(terms) + 1, dtype="int64")
+        np.cumsum(np.bincount(term, minlength=len(terms)), out=offsets[1:])
+        doc_len = np.frombuffer(doc_len, dtype="float32").copy()
+        doc_ids = np.arange(n_rows, dtype="int64") if ids is None else np.asarray(ids, dtype="int64")
+        return cls(terms, offsets, postings_doc, postings_tf, doc_len, doc_ids)
+
+    def term_id(self, tok: str) -> Optional[int]:
+        t = bisect.bisect_left(self.terms, tok)
+        return t if t < len(self.terms) and self.terms[t] == tok else None
+
+    def search(self, query: str, top_k: int):
+        """Returns (chunk ids, scores), best first."""
+        n_docs = len(self.doc_len)
+        rows, scores = [], []
+        for tok in set(tokenize(query)):
+            t = self.term_id(tok)
+            if t is None:
+                continue
+            lo, hi = self.offsets[t], self.offsets[t + 1]
+            docs = self.postings_doc[lo:hi]
+            tf = self.postings_tf[lo:hi]
+            idf = math.log(1 + (n_docs - (hi - lo) + 0.5) / ((hi - lo) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_len[docs] / self.avgdl)
+            rows.append(docs)
+            scores.append(idf * tf * (BM25_K1 + 1) / (tf + norm))
+        if not rows:
+            return np.empty(0, dtype="int64"), np.empty(0, dtype="float32")
+        uniq, inv = np.unique(np.concatenate(rows), return_inverse=True)
+        totals = np.bincount(inv, weights=np.concatenate(scores))
+        k = min(top_k, len(uniq))
+        best = np.argpartition(-totals, k - 1)[:k]
+        best = best[np.argsort(-totals[best])]
+        return self.doc_ids[uniq[best]], totals[best].astype("float32")
+
+    ARRAYS = ("offsets", "postings_doc", "postings_tf", "doc_len", "doc_ids")
+
+    def save(self, path: Path):
+        """Writes a folder of .npy files plus the term TextTable; replaces any previous one."""
+        tmp = path.with_name(path.name + ".tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        tmp.mkdir(parents=True)
+        for name in self.ARRAYS:
+            np.save(tmp / f"{name}.npy", getattr(self, name))
+        TextTable.write(tmp, "terms", self.terms)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: Path):
+        """Memory-maps a saved index: nothing but doc_len (for the average) is read up front."""
+        arrays = [np.load(path / f"{name}.npy", mmap_mode="r") for name in cls.ARRAYS]
+        return cls(TextTable.open(path, "terms"), *arrays)
+
+def bm25_path(entry: Path) -> Path:
+    return entry / f"bm25-v{TOKENIZER_VERSION}"
+
+def load_or_build_bm25(path: Path, texts: Iterable[str], ids=None) -> BM25Index:
+    if path.exists():
+        try:
+            return BM25Index.load(path)
+        except Exception as e:
+            print(f"Rebuilding unreadable lexical index: {e}")
+    bm25 = BM25Index.build(texts, ids)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    bm25.save(path)
+    for old in path.parent.glob("bm25*"):  # other tokenizer versions, or the older bm25.npz
+        if old == path:
+            continue
+        if old.is_dir():
+            shutil.rmtree(old, ignore_errors=True)
+        else:
+            old.unlink(missing_ok=True)
+    del bm25
+    return BM25Index.load(path)  # memory-mapped, so the built arrays don't stay resident
+
+def cache_bm25(key: str, chunks_meta) -> BM25Index:
+    return load_or_build_bm25(bm25_path(CACHE_DIR / key), (c.text for c in chunks_meta))
+
+# ---------- Retrieval ----------
 def retrieve(index, query_emb: np.ndarray, top_k: int):
     D, I = index.search(query_emb, top_k)
     return I[0], D[0]
 
-# ---------- Main ----------
-def main(pdf_file: str):
-    pdf_path = Path(pdf_file)
-    if not pdf_path.exists():
-        print("File not found:", pdf_path)
-        return
+def mmr_rerank(q_vec: np.ndarray, ids: np.ndarray, scores: np.ndarray, vecs: np.ndarray,
+               top_k: int, lam: float = None):
+    """
+    Maximal marginal relevance over one query's candidates: repeatedly picks the
+    candidate maximizing lam * sim(query) - (1 - lam) * max sim(already picked).
+    All pairwise similarities come from one matrix product. Keeps the original scores.
+    """
+    lam = MMR_LAMBDA if lam is None else lam
+    rel = vecs @ q_vec
+    pair = vecs @ vecs.T
+    picked = [int(np.argmax(rel))]
+    max_sim = pair[picked[0]].copy()
+    for _ in range(1, min(top_k, len(ids))):
+        mmr = lam * rel - (1 - lam) * max_sim
+        mmr[picked] = -np.inf
+        j = int(np.argmax(mmr))
+        picked.append(j)
+        np.maximum(max_sim, pair[j], out=max_sim)
+    return ids[picked], scores[picked]
 
-    print("Extracting text from PDF...")
-    text = extract_text_from_pdf(pdf_path)
-    if not text.strip():
-        print("No text found in PDF.")
-        return
+def search(index, bm25, questions: List[str], q_emb: np.ndarray, top_k: int, vectors=None):
+    """
+    Batched search returning (I, D) like index.search, ids -1 where there are fewer hits.
+    In hybrid mode scores are reciprocal-rank-fusion scores, not cosines.
+    vectors(ids) -> float32 embeddings of those chunks; needed for the MMR re-rank.
+    """
+    if not (MMR and vectors is not None):
+        return _search(index, bm25, questions, q_emb, top_k)
+
+    I, D = _search(index, bm25, questions, q_emb, max(top_k, MMR_CANDIDATES))
+    out_I = np.full((len(questions), top_k), -1, dtype="int64")
+    out_D = np.zeros((len(questions), top_k), dtype="float32")
+    for row in range(len(questions)):
+        valid = I[row] >= 0
+        ids, scores = I[row][valid], D[row][valid]
+        if len(ids) == 0:
+            continue
+        ids, scores = mmr_rerank(q_emb[row], ids, scores, vectors(ids), top_k)
+        out_I[row, :len(ids)] = ids
+        out_D[row, :len(scores)] = scores
+    return out_I, out_D
+
+def _search(index, bm25, questions: List[str], q_emb: np.ndarray, top_k: int):
+    if RETRIEVAL == "dense" or bm25 is None:
+        D, I = index.search(q_emb, top_k)
+        return I, D
+
+    n_cand = max(top_k, FUSION_CANDIDATES)
+    out_I = np.full((len(questions), top_k), -1, dtype="int64")
+    out_D = np.zeros((len(questions), top_k), dtype="float32")
+    dense_I = index.search(q_emb, n_cand)[1] if RETRIEVAL == "hybrid" else None
+    for row, q in enumerate(questions):
+        lex_ids, lex_scores = bm25.search(q, n_cand)
+        if RETRIEVAL == "lexical":
+            ids, scores = lex_ids[:top_k], lex_scores[:top_k]
+        else:
+            fused = {}
+            for ranked in (dense_I[row], lex_ids):
+                for rank, i in enumerate(ranked):
+                    if i >= 0:
+                        fused[int(i)] = fused.get(int(i), 0.0) + 1.0 / (RRF_K + rank + 1)
+            best = sorted(fused.items(), key=lambda kv: kv[1], reverse=True)[:top_k]
+            ids = [i for i, _ in best]
+            scores = [sc for _, sc in best]
+        out_I[row, :len(ids)] = ids
+        out_D[row, :len(scores)] = scores
+    return out_I, out_D
+
+# ---------- Corpus (folder of PDFs) ----------
+CORPUS_INDEX_TYPES = ("flat", "sqfp16", "ivf", "ivfpq")
+
+def corpus_index_type() -> str:
+    # the shared index needs add_with_ids/remove_ids; HNSW can't remove and sq8 needs up-front training
+    return INDEX_TYPE if INDEX_TYPE in CORPUS_INDEX_TYPES else "flat"
+
+def train_corpus_index(index, state, ids: np.ndarray):
+    """
+    For --index ivf/ivfpq: the shared index stays a flat IndexIDMap2 until it holds
+    CORPUS_TRAIN_MIN chunks, then is rebuilt as a trained IVF-Flat / IVF-PQ (with a
+    hash-table direct map, so ids can still be removed and vectors reconstructed).
+    An IVF-Flat index is retrained whenever it has grown CORPUS_RETRAIN_GROWTH times,
+    so its list count keeps up with the corpus; IVF-PQ is trained once, since its
+    stored vectors are lossy and retraining on them would compound the error.
+    ids are the chunk ids in the index, ascending.
+    Returns the index to use from now on (the same object if nothing changed).
+    """
+    kind = corpus_index_type()
+    n = 0 if index is None else index.ntotal
+    trained_on = state.get("trained_on", 0)
+    if kind not in ("ivf", "ivfpq") or n < CORPUS_TRAIN_MIN:
+        return index
+    if trained_on and (kind == "ivfpq" or n < CORPUS_RETRAIN_GROWTH * trained_on):
+        return index
+    ivf = new_ivf_index(index.d, n, kind)
+    if ivf is None:
+        return index
+    print(f"Training the {kind} corpus index on {min(n, TRAIN_SAMPLE)} of {n} chunks...")
+    with timed("index_train"):
+        rng = np.random.default_rng(0)
+        sample = ids if n <= TRAIN_SAMPLE else np.sort(rng.choice(ids, TRAIN_SAMPLE, replace=False))
+        ivf.train(index.reconstruct_batch(np.asarray(sample, dtype="int64")))
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+        for lo in range(0, n, SCAN_BLOCK):
+            block = np.asarray(ids[lo:lo + SCAN_BLOCK], dtype="int64")
+            ivf.add_with_ids(index.reconstruct_batch(block), block)
+    state["trained_on"] = n
+    set_search_params(ivf)
+    return ivf
+
+def corpus_vectors(index):
+    """vectors(ids) for the MMR re-rank, or None if the index can't give vectors back by id."""
+    if isinstance(index, MemmapSearcher):
+        return index.rows
+    if isinstance(index, faiss.IndexIDMap2) or (
+            isinstance(index, faiss.IndexIVF) and index.direct_map.type == faiss.DirectMap.Hashtable):
+        return lambda ids: index.reconstruct_batch(np.asarray(ids, dtype="int64"))
+    return None
+
+def corpus_entry(folder: Path) -> Path:
+    # float32 keys are unchanged from before quantized corpus stores existed, so old caches stay valid
+    kind = corpus_index_type() if EMBED_STORE == "float32" else EMBED_STORE
+    params = f"{folder.resolve()}|{EMBED_MODEL_NAME}|{CHUNK_SIZE}|{CHUNK_OVERLAP}|{CHUNKER_VERSION}|{kind}"
+    return CACHE_DIR / ("corpus-" + hashlib.sha256(params.encode("utf-8")).hexdigest()[:32])
+
+class CorpusTable:
+    """
+    Chunk table of a corpus: a ChunkStore plus ids.npy, the chunk id of each row
+    (ascending), and with a quantized EMBED_STORE the row-aligned embeddings.
+    Everything is memory-mapped. Each change writes a new folder (see write()),
+    copying the surviving rows SCAN_BLOCK at a time, so RSS never grows with the corpus.
+    """
+
+    def __init__(self, folder: Path):
+        self.folder = folder
+        self.store = ChunkStore.open(folder)
+        self.ids = np.load(folder / "ids.npy", mmap_mode="r")
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, chunk_id: int) -> Chunk:
+        return self.store[int(np.searchsorted(self.ids, chunk_id))]
+
+    def texts(self):
+        return (self.store.texts[i] for i in range(len(self)))
+
+    def searcher(self) -> MemmapSearcher:
+        return MemmapSearcher.open(self.folder, self.ids)
+
+    @staticmethod
+    def write(folder: Path, old, removed, added):
+        """
+        Writes old's rows minus the id ranges in removed, then added: a list of
+        (ids, chunks, float32 embeddings or None), with ids above every old id.
+        With an int8 store the scale only ever widens; old rows are requantized to it.
+        """
+        shutil.rmtree(folder, ignore_errors=True)
+        folder.mkdir(parents=True)
+        n_old = 0 if old is None else len(old)
+        keep = np.ones(n_old, dtype=bool)
+        for first, stop in removed:
+            keep[np.searchsorted(old.ids, first):np.searchsorted(old.ids, stop)] = False
+        new_ids = [np.asarray(ids, dtype="int64") for ids, _, _ in added]
+        new_chunks = [c for _, chunks, _ in added for c in chunks]
+
+        old_texts = (old.store.texts[i] for i in np.flatnonzero(keep)) if n_old else ()
+        TextTable.write(folder, "chunk_texts", itertools.chain(old_texts, (c.text for c in new_chunks)))
+        new_rows = np.array([(c.start, c.end, c.page) for c in new_chunks], dtype="int64").reshape(-1, 3)
+        _write_rows(folder / "chunks.npy", old.store.rows if n_old else None, keep, new_rows)
+        _write_rows(folder / "ids.npy", old.ids if n_old else None, keep,
+                    np.concatenate([np.empty(0, dtype="int64")] + new_ids))
+        if EMBED_STORE == "float32":
+            return
+        emb = [e for _, _, e in added if e is not None and len(e)]
+        emb = np.vstack(emb) if emb else None
+        old_data = old.searcher() if n_old else None
+        scale, convert = None, None
+        if EMBED_STORE == "int8":
+            scale = old_data.scale if old_data is not None else None
+            if emb is not None:
+                wider = int8_scale(emb) if scale is None else np.maximum(scale, int8_scale(emb))
+                if scale is not None and (wider > scale).any():
+                    ratio = scale / wider
+
+                    def requantize(block):
+                        block = block * ratio  # one float32 copy of the block, rounded in place
+                        np.round(block, out=block)
+                        return np.clip(block, -127, 127, out=block)
+                    convert = requantize
+                scale = wider
+            if scale is not None:
+                np.save(folder / "scale.npy", scale)
+        if emb is None:
+            dim = old_data.data.shape[1] if old_data is not None else 0
+            new_data = np.empty((0, dim), dtype=EMBED_STORE)
+        else:
+            new_data = quantize_embeddings(emb, EMBED_STORE, scale)[0]
+        _write_rows(folder / "embeddings.npy", old_data.data if n_old else None, keep, new_data, convert)
+
+def _write_rows(path: Path, old, keep: np.ndarray, new: np.ndarray, convert=None):
+    """Saves old[keep] followed by new as one .npy, streamed through a memory map."""
+    n_old = int(keep.sum())
+    out = np.lib.format.open_memmap(path, mode="w+", dtype=new.dtype, shape=(n_old + len(new),) + new.shape[1:])
+    pos = 0
+    for lo in range(0, len(keep), SCAN_BLOCK):
+        block = np.asarray(old[lo:lo + SCAN_BLOCK])[keep[lo:lo + SCAN_BLOCK]]
+        out[pos:pos + len(block)] = block if convert is None else convert(block)
+        pos += len(block)
+    out[pos:] = new
+    out.flush()
+    del out
+
+def load_corpus(entry: Path):
+    """
+    Returns (state, table, index). state is the per-document table:
+      docs:  {relpath: {"size", "mtime", "sha256", "ids": [first, stop) chunk id range}}
+      generation: bumped per change; the CorpusTable lives in table-<generation>
+    index is keyed by chunk id: an IndexIDMap2 (IndexIDMap in older caches), or an
+    IVF index once a --index ivf/ivfpq corpus has been trained, or a MemmapSearcher
+    over the table with a quantized EMBED_STORE; None for an empty corpus.
+    state["trained_on"] is the chunk count the IVF index was last trained on.
+    Caches that kept every chunk in corpus.json are converted on first load.
+    """
+    state_file = entry / "corpus.json"
+    index_file = entry / "index.faiss"
+    quantized = EMBED_STORE != "float32"
+    if state_file.exists() and (quantized or index_file.exists()):
+        try:
+            with open(state_file, "r", encoding="utf-8") as f:
+                state = json.load(f)
+            index = None if quantized else faiss.read_index(str(index_file))
+            if "chunks" in state:
+                return migrate_corpus(entry, state, index)
+            table = CorpusTable(entry / f"table-{state['generation']}")
+            if quantized:
+                index = table.searcher()
+            if index.ntotal == len(table) == state["n_chunks"]:
+                if not quantized:
+                    set_search_params(index)
+                return state, table, index
+        except Exception as e:
+            print(f"Ignoring unreadable corpus cache {entry.name}: {e}")
+    return {"next_id": 0, "docs": {}, "n_chunks": 0, "generation": 0}, None, None
+
+def migrate_corpus(entry: Path, state, index):
+    """Moves the chunks of a corpus.json written before CorpusTable existed into table-1."""
+    chunks = state.pop("chunks")
+    if index.ntotal != len(chunks):
+        raise ValueError("index and chunk table disagree")
+    ids = sorted(int(i) for i in chunks)
+    rows = [chunks[str(i)] for i in ids]
+    for doc in state["docs"].values():
+        doc["ids"] = [doc["ids"][0], doc["ids"][-1] + 1] if doc["ids"] else [0, 0]
+    state["generation"], state["n_chunks"] = 1, len(ids)
+    CorpusTable.write(entry / "table-1", None, [], [(ids, [Chunk(r[4], r[2], r[3], r[1]) for r in rows], None)])
+    save_corpus(entry, state, index)
+    return state, CorpusTable(entry / "table-1"), index
+
+def save_corpus(entry: Path, state, index):
+    """corpus.json is written last and names the table generation, so it commits the change."""
+    entry.mkdir(parents=True, exist_ok=True)
+    if index is not None and not isinstance(index, MemmapSearcher):
+        faiss.write_index(index, str(entry / "index.faiss"))
+    with open(entry / "corpus.json", "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    for old in entry.glob("table-*"):
+        if old.name != f"table-{state['generation']}":
+            shutil.rmtree(old, ignore_errors=True)
+
+def update_corpus(folder: Path, workers: int = 1):
+    """
+    Brings the shared index in line with the PDFs currently in folder.
+    Unchanged files are detected by size+mtime, then by content hash.
+    Returns (state, table, index, bm25, model); model is None when nothing had to be
+    embedded (it may still be loading in the background).
+    """
+    entry = corpus_entry(folder)
+    state, table, index = load_corpus(entry)
+    docs = state["docs"]
+    quantized = EMBED_STORE != "float32"
+    model = None
+    changed = False
+    removed, added = [], []  # id ranges dropped, (ids, chunks, embeddings) indexed in this run
+
+    on_disk = {p.relative_to(folder).as_posix(): p for p in sorted(folder.rglob("*.pdf")) if p.is_file()}
+
+    def drop(rel):
+        first, stop = docs.pop(rel)["ids"]
+        if stop > first:
+            removed.append((first, stop))
+            if index is not None and not quantized:
+                index.remove_ids(np.arange(first, stop, dtype="int64"))
+
+    for rel in [r for r in docs if r not in on_disk]:
+        print(f"Removing deleted document: {rel}")
+        drop(rel)
+        changed = True
+
+    for rel, path in on_disk.items():
+        st = path.stat()
+        old = docs.get(rel)
+        if old and old["size"] == st.st_size and old["mtime"] == st.st_mtime:
+            continue
+        digest = file_sha256(path)
+        if old and old["sha256"] == digest:
+            old["mtime"] = st.st_mtime  # touched but not modified
+            changed = True
+            continue
+        if old:
+            print(f"Re-indexing changed document: {rel}")
+            drop(rel)
+        else:
+            print(f"Indexing new document: {rel}")
+
+        doc_chunks, embeddings = embed_pdf(path, workers, model)
+        first = state["next_id"]
+        ids = np.arange(first, first + len(doc_chunks), dtype="int64")
+        state["next_id"] += len(doc_chunks)
+        if doc_chunks:
+            model = load_model()
+            if quantized:
+                added.append((ids, doc_chunks, embeddings))
+            else:
+                if index is None:
+                    dim = embeddings.shape[1]
+                    if corpus_index_type() == "sqfp16":
+                        base = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+                    else:
+                        base = faiss.IndexFlatIP(dim)
+                    index = faiss.IndexIDMap2(base)  # IDMap2 can reconstruct vectors by id (MMR)
+                with timed("index"):
+                    index.add_with_ids(embeddings, ids)
+                added.append((ids, doc_chunks, None))
+        docs[rel] = {"size": st.st_size, "mtime": st.st_mtime, "sha256": digest, "ids": [first, state["next_id"]]}
+        changed = True
+
+    if removed or added or (changed and table is None):
+        with timed("index"):
+            state["generation"] += 1
+            CorpusTable.write(entry / f"table-{state['generation']}", table, removed, added)
+            del added
+            table = CorpusTable(entry / f"table-{state['generation']}")
+            state["n_chunks"] = len(table)
+            if quantized:
+                index = table.searcher()
+    if table is not None and not quantized:
+        trained = train_corpus_index(index, state, table.ids)
+        if trained is not index:
+            index, changed = trained, True
+
+    bm25_dir = bm25_path(entry)
+    if changed:
+        save_corpus(entry, state, index)
+        shutil.rmtree(bm25_dir, ignore_errors=True)  # cheap to rebuild, unlike the embeddings
+    bm25 = None
+    if table is not None and len(table) and RETRIEVAL != "dense":
+        bm25 = load_or_build_bm25(bm25_dir, table.texts(), table.ids)
+    print(f"Corpus: {len(docs)} documents, {state['n_chunks']} chunks.")
+    return state, table, index, bm25, model
+
+def encode_queries(model, questions: List[str]) -> np.ndarray:
+    return model.encode(questions, batch_size=QUERY_BATCH, convert_to_numpy=True,
+                        normalize_embeddings=True).astype('float32')
+
+def load_questions(path: Path) -> List[dict]:
+    """
+    .jsonl: one object per line with "question" (or "q") and an optional "id".
+    anything else: one question per non-empty line.
+    """
+    questions = []
+    with open(path, "r", encoding="utf-8") as f:
+        for n, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if path.suffix.lower() == ".jsonl":
+                obj = json.loads(line)
+                questions.append({"id": obj.get("id", n), "question": obj.get("question", obj.get("q", ""))})
+            else:
+                questions.append({"id": n, "question": line})
+    return questions
+
+# ---------- Query cache ----------
+def normalize_query(q: str) -> str:
+    return " ".join(q.lower().split()).rstrip("?!. ")
+
+class QueryCache:
+    """
+    Bounded LRU: normalized question -> (query embedding, top-k ids, scores).
+    Results are only valid for one index build and one set of search settings
+    (the fingerprint); embeddings only depend on the model, so a persisted cache
+    with a stale fingerprint keeps them and drops the results.
+    """
+
+    def __init__(self, max_size: int, fingerprint: str, path: Path = None):
+        self.max_size = max_size
+        self.fingerprint = fingerprint
+        self.path = path
+        self.entries = OrderedDict()  # key -> [emb, ids or None, scores or None]
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path is not None and path.exists():
+            self._load()
+
+    def lookup(self, q: str, k: int):
+        """Returns (emb, ids, scores); ids/scores are None when only the embedding is usable."""
+        key = normalize_query(q)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            emb, ids, scores = entry
+            if ids is None or len(ids) < k:
+                self.misses += 1
+                return emb, None, None
+            self.hits += 1
+            return emb, ids[:k], scores[:k]
 
-    print("Chunking text...")
-    chunks_meta = chunk_text(text)
-    chunks = [c[0] for c in chunks_meta]
-    print(f"Created {len(chunks)} chunks.")
+    def store(self, q: str, emb: np.ndarray, ids: np.ndarray, scores: np.ndarray):
+        key = normalize_query(q)
+        with self.lock:
+            self.entries[key] = [np.asarray(emb, dtype="float32"), np.asarray(ids), np.asarray(scores)]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
 
-    print("Loading embedding model (this may take a moment)...")
-    model = SentenceTransformer(EMBED_MODEL_NAME)
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "hit_rate": round(self.hits / total, 3) if total else 0.0}
 
-    print("Building embeddings...")
-    embeddings = build_embeddings(model, chunks)
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            items = list(self.entries.items())
+        if not items:
+            return
+        k = max((len(e[1]) for _, e in items if e[1] is not None), default=0)
+        ids = np.full((len(items), k), -1, dtype="int64")
+        scores = np.zeros((len(items), k), dtype="float32")
+        for row, (_, (_, i, sc)) in enumerate(items):
+            if i is None:
+                continue  # embedding only: saved with no ids
+            ids[row, :len(i)] = i
+            scores[row, :len(sc)] = sc
+        np.savez(self.path, keys=np.array([key for key, _ in items], dtype=str),
+                 emb=np.vstack([e[0] for _, e in items]), ids=ids, scores=scores,
+                 meta=np.array([EMBED_MODEL_NAME, self.fingerprint], dtype=str))
 
-    print("Creating FAISS index...")
-    index = create_faiss_index(embeddings)
+    def _load(self):
+        try:
+            with np.load(self.path) as z:
+                model_name, fingerprint = z["meta"].tolist()
+                if model_name != EMBED_MODEL_NAME:
+                    return
+                same_index = fingerprint == self.fingerprint
+                for key, emb, ids, scores in zip(z["keys"].tolist(), z["emb"], z["ids"], z["scores"]):
+                    n = int((ids >= 0).sum())
+                    self.entries[key] = [emb, ids[:n], scores[:n]] if same_index else [emb, None, None]
+        except Exception as e:
+            print(f"Ignoring unreadable query cache: {e}")
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
 
+def make_query_cache(entry: Path, index_marker: Path):
+    """index_marker is rewritten whenever the index is rebuilt; its mtime tags the results."""
+    if QUERY_CACHE_SIZE <= 0:
+        return None
+    built = index_marker.stat().st_mtime_ns if index_marker.exists() else 0
+    fingerprint = (f"{built}|{TOP_K}|{RETRIEVAL}|{INDEX_TYPE}|{NPROBE}|{EF_SEARCH}|{EMBED_STORE}"
+                   f"|{MMR}|{MMR_LAMBDA}|{TOKENIZER_VERSION}")
+    return QueryCache(QUERY_CACHE_SIZE, fingerprint, entry / "query_cache.npz" if PERSIST_QUERY_CACHE else None)
+
+# ---------- Main ----------
+def query_loop(index, describe, model=None, bm25=None, vectors=None, qcache=None):
+    """
+    describe(chunk id) -> (info dict e.g. {"page": 3}, chunk_text, start_char, end_char)
+    """
     print("\nReady. Ask questions about the PDF. Type 'exit' or 'quit' to stop.\n")
 
     while True:
@@ -104,20 +1374,449 @@ def main(pdf_file: str):
         if q.lower() in ("exit", "quit"):
             break
 
-        q_emb = model.encode([q], convert_to_numpy=True, normalize_embeddings=True).astype('float32')
-        ids, scores = retrieve(index, q_emb, TOP_K)
+        cached = qcache.lookup(q, TOP_K) if qcache else None
+        if cached is not None and cached[1] is not None:
+            _, ids, scores = cached  # repeated question: no encode, no search
+        else:
+            if cached is not None:
+                q_emb = cached[0][None, :]
+            else:
+                if model is None:
+                    # cache hit: the model kept loading in the background; join it now
+                    model = load_model()
+                q_emb = encode_queries(model, [q])
+            I, D = search(index, bm25, [q], q_emb, TOP_K, vectors)
+            ids, scores = I[0], D[0]
+            if qcache:
+                qcache.store(q, q_emb[0], ids, scores)
 
-        print(f"\nTop {TOP_K} relevant passages (score = cosine approx):\n")
+        score_kind = "cosine approx" if RETRIEVAL == "dense" or bm25 is None else RETRIEVAL
+        from_cache = " [cached]" if cached is not None and cached[1] is not None else ""
+        print(f"\nTop {TOP_K} relevant passages (score = {score_kind}){from_cache}:\n")
         for rank, (i, sc) in enumerate(zip(ids, scores), start=1):
-            chunk_text, s, e = chunks_meta[i]
-            snippet = chunk_text.replace("\n", " ").strip()
+            if i < 0:
+                break  # fewer chunks than TOP_K
+            info, text, s, e = describe(int(i))
+            label = " ".join(f"{k}={v}" for k, v in info.items())
+            snippet = text.replace("\n", " ").strip()
             snippet = (snippet[:400] + "…") if len(snippet) > 400 else snippet
-            print(f"[{rank}] score={sc:.4f}\n{s}-{e} → {snippet}\n")
+            print(f"[{rank}] score={sc:.4f} {label}\n{s}-{e} → {snippet}\n")
 
         print("-" * 80)
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python pdf_qa_offline.py path/to/document.pdf")
+    if qcache:
+        st = qcache.stats()
+        print(f"Query cache: {st['hits']} hits, {st['misses']} misses ({st['size']} entries).")
+        qcache.save()
+
+def answer_batch(index, describe, model, questions_file: Path, out_file: Path, bm25=None, vectors=None):
+    """
+    Encodes the questions in batches of QUERY_BATCH, runs one matrix search per batch
+    and writes one JSON line per question with its top-k passages.
+    """
+    questions = load_questions(questions_file)
+    if not questions:
+        print("No questions found in", questions_file)
+        return
+    if model is None:
+        model = load_model()
+
+    t0 = time.perf_counter()
+    with open(out_file, "w", encoding="utf-8") as out:
+        for b in range(0, len(questions), QUERY_BATCH):
+            batch = questions[b:b + QUERY_BATCH]
+            texts = [q["question"] for q in batch]
+            q_emb = encode_queries(model, texts)
+            I, D = search(index, bm25, texts, q_emb, TOP_K, vectors)
+            for q, ids, scores in zip(batch, I, D):
+                passages = []
+                for rank, (i, sc) in enumerate(zip(ids, scores), start=1):
+                    if i < 0:
+                        break
+                    info, text, s, e = describe(int(i))
+                    passages.append({"rank": rank, "score": round(float(sc), 6), **info,
+                                     "start": s, "end": e, "text": text})
+                out.write(json.dumps({"id": q["id"], "question": q["question"], "results": passages},
+                                     ensure_ascii=False) + "\n")
+    elapsed = time.perf_counter() - t0
+    print(f"Answered {len(questions)} questions in {elapsed:.2f}s "
+          f"({len(questions) / elapsed:.1f} q/s) -> {out_file}")
+
+# ---------- HTTP service ----------
+class MicroBatcher:
+    """
+    Single worker thread that owns the model and the index. Callers submit lists of
+    questions; whatever arrives within BATCH_WINDOW_MS of the first waiting request
+    (up to QUERY_BATCH questions) is encoded and searched in one call.
+    """
+
+    def __init__(self, index, describe, model, bm25=None, vectors=None, qcache=None):
+        self.index, self.describe, self.model, self.bm25 = index, describe, model, bm25
+        self.vectors = vectors
+        self.qcache = qcache
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies_ms = deque(maxlen=10000)
+        self.started = time.time()
+        self.queries = 0
+        self.batched = 0  # queries that went through the encoder (queries also counts cache hits)
+        self.batches = 0
+        self.error = None  # set if the model failed to load; every batch then fails with it
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, questions: List[str], k: int) -> List[list]:
+        t0 = time.perf_counter()
+        results = [None] * len(questions)
+        pending = []
+        for n, q in enumerate(questions):
+            cached = self.qcache.lookup(q, k) if self.qcache else None
+            if cached is not None and cached[1] is not None:
+                results[n] = self._passages(cached[1], cached[2], k)
+            else:
+                pending.append(n)
+        if pending:
+            job = {"questions": [questions[n] for n in pending], "k": k,
+                   "done": threading.Event(), "t0": t0}
+            self.jobs.put(job)
+            if not job["done"].wait(REQUEST_TIMEOUT):
+                raise TimeoutError(f"no answer within {REQUEST_TIMEOUT}s")
+            if "error" in job:
+                raise job["error"]
+            for n, r in zip(pending, job["results"]):
+                results[n] = r
+        with self.lock:
+            self.queries += len(questions) - len(pending)  # batched ones are counted in _answer
+            if not pending:
+                self.latencies_ms.append((time.perf_counter() - t0) * 1000)
+        return results
+
+    def _passages(self, ids, scores, k) -> list:
+        passages = []
+        for rank, (i, sc) in enumerate(zip(ids[:k], scores), start=1):
+            if i < 0:
+                break
+            info, text, s, e = self.describe(int(i))
+            passages.append({"rank": rank, "score": round(float(sc), 6), **info,
+                             "start": s, "end": e, "text": text})
+        return passages
+
+    def _run(self):
+        if self.model is None:
+            try:
+                self.model = load_model()
+            except Exception as e:
+                self.error = RuntimeError(f"model failed to load: {e}")
+                print(f"Error: {self.error}")
+        while True:
+            jobs = [self.jobs.get()]
+            if self.error is not None:
+                self._fail(jobs, self.error)
+                continue
+            n = len(jobs[0]["questions"])
+            deadline = time.perf_counter() + BATCH_WINDOW_MS / 1000
+            while n < QUERY_BATCH:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    job = self.jobs.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                jobs.append(job)
+                n += len(job["questions"])
+            self._answer(jobs)
+
+    def _answer(self, jobs):
+        texts = [q for job in jobs for q in job["questions"]]
+        k = max(job["k"] for job in jobs)
+        try:
+            q_emb = encode_queries(self.model, texts)
+            I, D = search(self.index, self.bm25, texts, q_emb, k, self.vectors)
+        except Exception as e:
+            self._fail(jobs, e)
+            return
+        if self.qcache:
+            for q, emb, ids, scores in zip(texts, q_emb, I, D):
+                self.qcache.store(q, emb, ids, scores)
+        row = 0
+        now = time.perf_counter()
+        for job in jobs:
+            n = len(job["questions"])
+            results = [self._passages(ids, scores, job["k"]) for ids, scores in zip(I[row:row + n], D[row:row + n])]
+            row += n
+            job["results"] = results
+            with self.lock:
+                self.latencies_ms.append((now - job["t0"]) * 1000)
+            job["done"].set()
+        with self.lock:
+            self.queries += len(texts)
+            self.batched += len(texts)
+            self.batches += 1
+
+    @staticmethod
+    def _fail(jobs, error):
+        for job in jobs:
+            job["error"] = error
+            job["done"].set()
+
+    def metrics(self) -> dict:
+        with self.lock:
+            lat = np.array(self.latencies_ms) if self.latencies_ms else np.zeros(1)
+            uptime = time.time() - self.started
+            return {
+                "queries": self.queries,
+                "batches": self.batches,
+                "avg_batch_size": round(self.batched / self.batches, 2) if self.batches else 0,
+                "qps": round(self.queries / uptime, 2) if uptime > 0 else 0,
+                "latency_ms_p50": round(float(np.percentile(lat, 50)), 2),
+                "latency_ms_p99": round(float(np.percentile(lat, 99)), 2),
+                "uptime_s": round(uptime, 1),
+                "query_cache": self.qcache.stats() if self.qcache else None,
+            }
+
+def parse_k(value) -> int:
+    """k from a query string or a JSON body: an integer from 1 to MAX_K."""
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError("must be an integer")
+    k = int(value)
+    if not 1 <= k <= MAX_K:
+        raise ValueError(f"must be between 1 and {MAX_K}")
+    return k
+
+def parse_questions(value) -> List[str]:
+    """The "questions" of a bulk request: a list of non-empty strings."""
+    if not isinstance(value, list) or not all(isinstance(q, str) for q in value):
+        raise ValueError('"questions" must be a list of strings')
+    questions = [q.strip() for q in value]
+    if not all(questions):
+        raise ValueError("empty question")
+    return questions
+
+def serve_http(index, describe, model, bm25=None, port: int = 8765, vectors=None, qcache=None):
+    batcher = MicroBatcher(index, describe, model, bm25, vectors, qcache)
+
+    class Handler(BaseHTTPRequestHandler):
+        def _answer(self, questions, k):
+            """batcher.submit() or an error response; None if the error was already sent."""
+            try:
+                return batcher.submit(questions, k)
+            except TimeoutError as e:
+                self._send(504, {"error": str(e)})
+            except Exception as e:
+                self._send(500, {"error": f"search failed: {e}"})
+            return None
+
+        def _send(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            if url.path == "/metrics":
+                self._send(200, batcher.metrics())
+            elif url.path == "/search":
+                q = params.get("q", [""])[0].strip()
+                if not q:
+                    self._send(400, {"error": "missing ?q="})
+                    return
+                try:
+                    k = parse_k(params.get("k", [TOP_K])[0])
+                except ValueError as e:
+                    self._send(400, {"error": f"bad k: {e}"})
+                    return
+                results = self._answer([q], k)
+                if results is not None:
+                    self._send(200, {"question": q, "results": results[0]})
+            else:
+                self._send(404, {"error": "not found"})
+
+        def do_POST(self):
+            # bulk: {"questions": ["...", ...], "k": 5}
+            if urlparse(self.path).path != "/search":
+                self._send(404, {"error": "not found"})
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if not isinstance(body, dict):
+                    raise ValueError("body must be a JSON object")
+                questions = parse_questions(body.get("questions", []))
+                k = parse_k(body.get("k", TOP_K))
+            except (ValueError, TypeError, AttributeError) as e:
+                self._send(400, {"error": f"bad request: {e}"})
+                return
+            if not questions:
+                self._send(400, {"error": "no questions"})
+                return
+            results = self._answer(questions, k)
+            if results is not None:
+                self._send(200, {"results": [{"question": q, "results": r}
+                                             for q, r in zip(questions, results)]})
+
+        def log_message(self, fmt, *args):
+            pass  # keep the console for startup info; use /metrics instead
+
+    server = ThreadingHTTPServer((SERVE_HOST, port), Handler)
+    print(f"\nServing on http://{SERVE_HOST}:{port}  (/search?q=..., POST /search, /metrics). Ctrl+C to stop.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if qcache:
+            qcache.save()
+
+def run_queries(index, describe, model, questions: str = None, out: str = None, bm25=None,
+                vectors=None, qcache=None):
+    if SERVE_PORT:
+        serve_http(index, describe, model, bm25, SERVE_PORT, vectors, qcache)
+    elif questions:
+        qpath = Path(questions)
+        answer_batch(index, describe, model, qpath, Path(out) if out else qpath.with_suffix(".results.jsonl"),
+                     bm25, vectors)
     else:
-        main(sys.argv[1])
+        query_loop(index, describe, model, bm25, vectors, qcache)
+
+def main_corpus(folder: Path, workers: int = 1, bench_index: bool = False,
+                questions: str = None, out: str = None):
+    if EMBED_STORE == "float32" and corpus_index_type() != INDEX_TYPE:
+        print(f"Warning: --index {INDEX_TYPE} isn't supported in corpus mode "
+              f"(use one of {', '.join(CORPUS_INDEX_TYPES)}); using {corpus_index_type()}.")
+    state, table, index, bm25, model = update_corpus(folder, workers)
+    if index is None or index.ntotal == 0:
+        print("No text found in any PDF.")
+        return
+    print_timings()
+    vectors = corpus_vectors(index)
+    if bench_index:
+        if isinstance(index, MemmapSearcher):
+            embeddings = index.dequantized()
+        elif vectors is not None:
+            embeddings = vectors(table.ids)
+        else:  # IndexIDMap from an older cache: read the flat index underneath
+            base = faiss.downcast_index(index.index)
+            embeddings = base.reconstruct_n(0, base.ntotal)
+        benchmark_indexes(embeddings, k=max(TOP_K, 10))
+        return
+
+    # documents own contiguous chunk id ranges, so a chunk's document is found by bisection
+    starts = sorted((d["ids"][0], rel) for rel, d in state["docs"].items() if d["ids"][1] > d["ids"][0])
+    firsts = [first for first, _ in starts]
+
+    def describe(i):
+        c = table[i]
+        rel = starts[bisect.bisect_right(firsts, i) - 1][1]
+        return {"doc": rel, "page": c.page}, c.text, c.start, c.end
+
+    if vectors is None and MMR:
+        print("MMR needs a corpus index built by this version; delete the corpus cache to enable it.")
+
+    entry = corpus_entry(folder)
+    qcache = make_query_cache(entry, entry / "corpus.json")
+    run_queries(index, describe, model, questions, out, bm25, vectors, qcache)
+
+def main(pdf_file: str, workers: int = 1, bench_index: bool = False,
+         questions: str = None, out: str = None):
+    pdf_path = Path(pdf_file)
+    if not pdf_path.exists():
+        print("File not found:", pdf_path)
+        return
+    if not bench_index:
+        start_model_loading()  # overlaps with extraction/chunking below
+    if pdf_path.is_dir():
+        main_corpus(pdf_path, workers, bench_index, questions, out)
+        return
+
+    model = None
+    key = cache_key(pdf_path)
+    with timed("load cache"):
+        cached = load_cache(key)
+    if cached is not None:
+        chunks_meta, embeddings, index = cached
+        print(f"Loaded {len(chunks_meta)} chunks from cache ({CACHE_DIR / key}).")
+    else:
+        print("Extracting, chunking and embedding PDF...")
+        chunks_meta, embeddings = embed_pdf(pdf_path, workers)
+        if not chunks_meta:
+            print("No text found in PDF.")
+            return
+        print(f"Created {len(chunks_meta)} chunks.")
+        model = load_model()
+
+        with timed("index"):
+            if EMBED_STORE == "float32":
+                print("Creating FAISS index...")
+                index = create_faiss_index(embeddings)
+                save_cache(key, pdf_path, chunks_meta, embeddings, index)
+            else:
+                print(f"Storing {EMBED_STORE} embeddings (memory-mapped)...")
+                data, scale = quantize_embeddings(embeddings, EMBED_STORE)
+                del embeddings
+                save_cache(key, pdf_path, chunks_meta, data, scale=scale)
+                index = MemmapSearcher.open(CACHE_DIR / key)
+                embeddings = index.data
+
+    if bench_index:
+        if isinstance(index, MemmapSearcher):
+            embeddings = index.dequantized()
+        benchmark_indexes(embeddings, k=max(TOP_K, 10))
+        return
+
+    with timed("lexical"):
+        bm25 = cache_bm25(key, chunks_meta) if RETRIEVAL != "dense" else None
+    print_timings()
+
+    def describe(i):
+        c = chunks_meta[i]
+        return {"page": c.page}, c.text, c.start, c.end
+
+    def vectors(ids):
+        if isinstance(index, MemmapSearcher):
+            return index.rows(ids)
+        return np.asarray(embeddings[ids], dtype="float32")
+
+    qcache = make_query_cache(CACHE_DIR / key, CACHE_DIR / key / "chunks.json")
+    run_queries(index, describe, model, questions, out, bm25, vectors, qcache)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline PDF Q&A with local embeddings.")
+    parser.add_argument("pdf", help="path/to/document.pdf, or a folder of PDFs (corpus mode)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help=f"processes for page extraction (this machine has {os.cpu_count()} cores)")
+    parser.add_argument("--index", choices=["flat", "ivf", "ivfpq", "hnsw", "sq8", "sqfp16"], default=INDEX_TYPE,
+                        help="FAISS index type (corpus mode supports flat, sqfp16, ivf and ivfpq)")
+    parser.add_argument("--store", choices=["float32", "float16", "int8"], default=EMBED_STORE,
+                        help="float16/int8: memory-mapped quantized embeddings instead of a FAISS index")
+    parser.add_argument("--nprobe", type=int, default=NPROBE, help="IVF lists searched per query")
+    parser.add_argument("--ef-search", type=int, default=EF_SEARCH, help="HNSW search breadth")
+    parser.add_argument("--bench-index", action="store_true",
+                        help="compare recall@k, latency and memory of all index types, then exit")
+    parser.add_argument("--questions", help="answer every question in this .txt/.jsonl file instead of the prompt")
+    parser.add_argument("--out", help="JSONL output for --questions (default: <questions>.results.jsonl)")
+    parser.add_argument("--retrieval", choices=["dense", "lexical", "hybrid"], default=RETRIEVAL,
+                        help="embedding search, BM25 keyword search, or both fused (default)")
+    parser.add_argument("--encode-workers", type=int, default=ENCODE_WORKERS,
+                        help="processes used to encode chunks (sharded encode_multi_process)")
+    parser.add_argument("--mmr", action="store_true", help="diversify results with maximal marginal relevance")
+    parser.add_argument("--mmr-lambda", type=float, default=MMR_LAMBDA,
+                        help="MMR trade-off: 1.0 = relevance only, 0.0 = diversity only")
+    parser.add_argument("--query-cache-size", type=int, default=QUERY_CACHE_SIZE,
+                        help="LRU entries for repeated questions (0 disables)")
+    parser.add_argument("--persist-query-cache", action="store_true",
+                        help="keep the repeated-question cache between sessions")
+    parser.add_argument("--serve", type=int, metavar="PORT",
+                        help="serve queries over local HTTP on PORT instead of the prompt")
+    args = parser.parse_args()
+    INDEX_TYPE, NPROBE, EF_SEARCH = args.index, args.nprobe, args.ef_search
+    EMBED_STORE = args.store
+    SERVE_PORT = args.serve
+    ENCODE_WORKERS, MMR, MMR_LAMBDA = max(1, args.encode_workers), args.mmr, args.mmr_lambda
+    RETRIEVAL = args.retrieval
+    QUERY_CACHE_SIZE, PERSIST_QUERY_CACHE = args.query_cache_size, args.persist_query_cache
+    main(args.pdf, workers=args.workers, bench_index=args.bench_index,
+         questions=args.questions, out=args.out)